@@ -0,0 +1,86 @@
+"""Weigh gzip levels and MessagePack against a sync page.
+
+The page is built the way /v1/sync encodes one, from pins shaped like real
+ones, so this needs neither a database nor the app:
+
+    python -m benchmarks.compression --pins 500
+
+benchmarks.suite measures the encodings on full syncs of a seeded database.
+"""
+import argparse
+import gzip
+import json
+import random
+import time
+import uuid
+
+import msgpack
+
+TITLES = ['Weather', 'Calendar', 'Sports', 'Reminder', 'Flight', 'Delivery']
+ICONS = ['system://images/TIMELINE_SUN', 'system://images/TIMELINE_CALENDAR', 'system://images/TIMELINE_SPORTS',
+         'system://images/NOTIFICATION_REMINDER', 'system://images/SCHEDULED_FLIGHT', 'system://images/GENERIC_SHIPPING']
+
+
+def make_update(i, rng):
+    kind = rng.randrange(len(TITLES))
+    return {
+        'type': 'timeline.pin.create',
+        'data': {
+            'time': f'2026-10-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00.000Z',
+            'layout': {
+                'type': 'genericPin',
+                'title': f'{TITLES[kind]} #{i}',
+                'subtitle': f'{rng.randint(0, 40)}° and {rng.choice(["sunny", "cloudy", "raining"])}',
+                'body': ' '.join(rng.choice(['Lorem', 'ipsum', 'dolor', 'sit', 'amet', 'gate', 'B12', 'on', 'time'])
+                                 for _ in range(rng.randint(5, 30))),
+                'tinyIcon': ICONS[kind],
+                'largeIcon': ICONS[kind],
+                'foregroundColor': '#FFFFFF',
+                'backgroundColor': '#0055AA',
+            },
+            'guid': str(uuid.UUID(int=rng.getrandbits(128))),
+            'dataSource': f'uuid:{uuid.UUID(int=kind)}',
+            'source': 'web',
+            'createTime': '2026-10-01T12:00:00.000Z',
+            'updateTime': '2026-10-01T12:00:00.000Z',
+            'topicKeys': [],
+            'reminders': [{'time': '2026-10-01T11:45:00.000Z', 'layout': {'type': 'genericReminder', 'title': TITLES[kind],
+                                                                          'tinyIcon': ICONS[kind]}}],
+            'actions': [{'type': 'openWatchApp', 'title': 'Open', 'launchCode': rng.randint(0, 1000)}],
+        },
+    }
+
+
+def measure(encode, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = encode()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pins', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    page = {'updates': [make_update(i, rng) for i in range(args.pins)], 'syncURL': 'https://example.com/v1/sync', 'hasMore': True}
+    body = json.dumps(page).encode('utf-8')
+    print(f"{args.pins} pins, {len(body)} bytes of JSON")
+
+    for level in (1, 6, 9):
+        compressed, elapsed = measure(lambda: gzip.compress(body, level), args.repeat)
+        print(f"  gzip {level}: {len(compressed):9d} bytes ({len(compressed) / len(body):6.1%}), "
+              f"{elapsed * 1000:7.2f} ms, {elapsed * 1e6 / ((len(body) - len(compressed)) / 1024):6.1f} µs per KiB saved")
+
+    packed, elapsed = measure(lambda: msgpack.packb(page, use_bin_type=True), args.repeat)
+    print(f"  msgpack: {len(packed):9d} bytes ({len(packed) / len(body):6.1%}), {elapsed * 1000:7.2f} ms")
+    compressed, elapsed = measure(lambda: gzip.compress(packed, 6), args.repeat)
+    print(f"  msgpack + gzip 6: {len(compressed):9d} bytes ({len(compressed) / len(body):6.1%}), {elapsed * 1000:7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
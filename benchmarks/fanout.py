@@ -0,0 +1,82 @@
+"""Compare shared-pin fan-out strategies on a seeded topic.
+
+Run against a scratch Postgres database, which gets its tables created and
+is left seeded afterwards:
+
+    DATABASE_URL=postgresql://localhost/timeline_bench python -m benchmarks.fanout --subscribers 200000
+"""
+import argparse
+import datetime
+import time
+import tracemalloc
+import uuid
+
+from timeline_sync import app
+from timeline_sync.models import db, TimelinePin, TimelineTopic, UserTimeline, fan_out_pin, record_user_changes
+
+PIN_JSON = {
+    'id': 'bench-pin',
+    'time': '2030-01-01T00:00:00Z',
+    'layout': {'type': 'genericPin', 'title': 'Benchmark', 'tinyIcon': 'system://images/NOTIFICATION_FLAG'},
+}
+
+
+def seed_topic(subscribers):
+    topic = TimelineTopic(app_uuid=uuid.uuid4(), name='bench')
+    db.session.add(topic)
+    db.session.flush()
+    db.session.execute('INSERT INTO timeline_topic_subscriptions (user_id, topic_id) '
+                       'SELECT g, :topic_id FROM generate_series(1, :subscribers) g',
+                       {'topic_id': topic.id, 'subscribers': subscribers})
+    db.session.commit()
+    return topic
+
+
+def legacy_fan_out(pin, topics, event_type):
+    # What shared_pin() used to do.
+    for topic in topics:
+        for subscription in topic.subscriptions:
+            db.session.add(UserTimeline(user_id=subscription.user_id, type=event_type, pin=pin))
+    db.session.flush()
+
+
+def set_based_fan_out(pin, topics, event_type):
+    record_user_changes(timeline_events=fan_out_pin(pin.guid, [topic.id for topic in topics], event_type))
+
+
+def run(strategy, topic):
+    topic = db.session.merge(topic)
+    pin = TimelinePin.from_json(PIN_JSON, topic.app_uuid, None, 'bench', 'web', [topic])
+    db.session.add(pin)
+    db.session.flush()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    strategy(pin, [topic], 'timeline.pin.create')
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    db.session.rollback()
+    db.session.expunge_all()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscribers', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        topic = seed_topic(args.subscribers)
+        print(f"{args.subscribers} subscribers, seeded at {datetime.datetime.utcnow()}")
+        for name, strategy in (('legacy', legacy_fan_out), ('set-based', set_based_fan_out)):
+            for _ in range(args.repeat):
+                elapsed, peak = run(strategy, topic)
+                print(f"{name:>10}: {elapsed * 1000:10.1f} ms, peak Python memory {peak / 1024 / 1024:8.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Compare row-by-row pin expiry with dropping daily time partitions.
+
+Seeds timeline_pins and user_timeline, then builds copies of both that are
+range-partitioned by day: pins by their time, events by a denormalized
+expiry column.  Reports index sizes for both layouts, then the time taken to
+expire the same pins: delete_expired_pins() plus a VACUUM for the current
+layout, dropping whole partitions for the other.  Run against a scratch
+Postgres database, which gets its tables dropped and created again; the
+partitioned copies are dropped at the end:
+
+    DATABASE_URL=postgresql://localhost/timeline_bench python -m benchmarks.partitioning --pins 1000000
+"""
+import argparse
+import datetime
+import time
+
+from timeline_sync import app
+from timeline_sync.models import db, delete_expired_pins, PIN_RETENTION
+
+
+def seed(args):
+    db.session.execute("""
+        INSERT INTO timeline_pins (guid, app_uuid, user_id, id, time, layout, data_source, source, create_time, update_time)
+        SELECT md5(g::text)::uuid, '6f3b1c52-6c9e-4c47-8a5e-1e2b3c4d5e6f', g % :users + 1, 'pin-' || g,
+               :start + (g % (:days * 24)) * interval '1 hour', '{"type": "genericPin", "title": "Benchmark"}',
+               'web', 'web', :now, :now
+        FROM generate_series(1, :pins) g
+    """, {'users': args.users, 'days': args.days, 'pins': args.pins, 'now': datetime.datetime.utcnow(), 'start': start_time(args)})
+    db.session.execute("INSERT INTO user_timeline (user_id, type, pin_id) "
+                       "SELECT user_id, 'timeline.pin.create', guid FROM timeline_pins ORDER BY time")
+    db.session.commit()
+
+
+def start_time(args):
+    today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - datetime.timedelta(days=args.past_days)
+
+
+def partition_days(args):
+    # One more day at either end, for the retention offset of the events.
+    start = start_time(args)
+    return [start + datetime.timedelta(days=n) for n in range(args.days + 4)]
+
+
+def build_partitioned(args):
+    # Every unique index has to include the partition key, so neither a pin
+    # nor a user's event for it is unique on its own any more.
+    db.session.execute("""
+        DROP TABLE IF EXISTS partitioned_pins, partitioned_events;
+        CREATE TABLE partitioned_pins (LIKE timeline_pins) PARTITION BY RANGE (time);
+        ALTER TABLE partitioned_pins ADD PRIMARY KEY (guid, time);
+        CREATE UNIQUE INDEX ON partitioned_pins (app_uuid, user_id, id, time);
+        CREATE UNIQUE INDEX ON partitioned_pins (app_uuid, id, time) WHERE user_id IS NULL;
+        CREATE INDEX ON partitioned_pins (deleted_time) WHERE deleted_time IS NOT NULL;
+        CREATE TABLE partitioned_events (LIKE user_timeline, expires timestamp NOT NULL)
+            PARTITION BY RANGE (expires);
+        ALTER TABLE partitioned_events ADD PRIMARY KEY (id, expires);
+        CREATE UNIQUE INDEX ON partitioned_events (user_id, pin_id, expires);
+        CREATE INDEX ON partitioned_events (user_id, id);
+        CREATE INDEX ON partitioned_events (pin_id);
+        CREATE INDEX ON partitioned_events (user_id);
+    """)
+    days = partition_days(args)
+    for day, next_day in zip(days, days[1:]):
+        for table in ('partitioned_pins', 'partitioned_events'):
+            db.session.execute(f"CREATE TABLE {table}_{day:%Y%m%d} PARTITION OF {table} "
+                               f"FOR VALUES FROM ('{day}') TO ('{next_day}')")
+    db.session.execute("INSERT INTO partitioned_pins SELECT * FROM timeline_pins")
+    db.session.execute("INSERT INTO partitioned_events "
+                       "SELECT user_timeline.*, timeline_pins.time + :retention FROM user_timeline "
+                       "JOIN timeline_pins ON timeline_pins.guid = user_timeline.pin_id",
+                       {'retention': PIN_RETENTION})
+    db.session.commit()
+
+
+def sizes(table, partitioned):
+    relations = f"SELECT relid FROM pg_partition_tree('{table}')" if partitioned else f"SELECT '{table}'::regclass"
+    return db.session.execute(f"SELECT sum(pg_indexes_size(relid)), sum(pg_table_size(relid)) FROM ({relations}) r(relid)").first()
+
+
+def vacuum(tables):
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for table in tables:
+            connection.execute(f'VACUUM {table}')
+
+
+def expire_rows():
+    start = time.perf_counter()
+    deleted = delete_expired_pins(app, time_budget=3600)['pins']
+    deleting = time.perf_counter() - start
+    vacuum(['timeline_pins', 'user_timeline'])
+    return deleted, deleting, time.perf_counter() - start - deleting
+
+
+def drop_partitions(args):
+    cutoff = datetime.datetime.utcnow() - PIN_RETENTION
+    start = time.perf_counter()
+    days = partition_days(args)
+    dropped = 0
+    for day, next_day in zip(days, days[1:]):
+        if next_day <= cutoff:
+            db.session.execute(f"DROP TABLE partitioned_pins_{day:%Y%m%d}")
+            dropped += 1
+        if next_day <= cutoff + PIN_RETENTION:
+            db.session.execute(f"DROP TABLE partitioned_events_{day:%Y%m%d}")
+    db.session.commit()
+    return dropped, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pins', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=30, help="days of pin times to spread the pins over")
+    parser.add_argument('--past-days', type=int, default=10, help="how many of those days are in the past")
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.session.execute('DROP TABLE IF EXISTS partitioned_pins, partitioned_events')
+        db.session.commit()
+        db.drop_all()
+        db.create_all()
+        seed(args)
+        build_partitioned(args)
+        db.session.execute('ANALYZE')
+        db.session.commit()
+
+        print(f"{args.pins} pins for {args.users} users over {args.days} days, {args.past_days} of them past")
+        for name, tables, partitioned in (('current', ('timeline_pins', 'user_timeline'), False),
+                                          ('partitioned', ('partitioned_pins', 'partitioned_events'), True)):
+            for table in tables:
+                index_size, table_size = sizes(table, partitioned)
+                print(f"{name:>12} {table:>18}: indexes {index_size / 2 ** 20:8.1f} MiB, table {table_size / 2 ** 20:8.1f} MiB")
+
+        deleted, deleting, vacuuming = expire_rows()
+        print(f"{'current':>12}: deleted {deleted} pins in {deleting:.2f} s, then vacuumed in {vacuuming:.2f} s")
+        dropped, dropping = drop_partitions(args)
+        print(f"{'partitioned':>12}: dropped {dropped} days of pins in {dropping:.2f} s")
+
+        db.session.execute('DROP TABLE partitioned_pins, partitioned_events')
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""Benchmark the API's hot paths end to end, against a seeded local Postgres.
+
+The auth service and the appstore are replaced by the tests' stub, and
+requests go through the Flask app in-process.  Run against a scratch database, which
+gets its tables created and is left seeded afterwards:
+
+    DATABASE_URL=postgresql://localhost/timeline_bench python -m benchmarks.suite --reset --output results.json
+
+Pass --baseline with an earlier run's results to see what changed.  Rate
+limits are turned off, since each endpoint is hit --requests times with a
+handful of tokens.
+"""
+import argparse
+import datetime
+import json
+import random
+import statistics
+import time
+import timeit
+import uuid
+
+from sqlalchemy import event
+
+from timeline_sync import app, upstream
+from timeline_sync.api import MSGPACK_MIMETYPE
+from timeline_sync.models import db, AppGlance, TimelinePin, TimelineTopic, upsert_pins, write_glance_event, write_pin_events
+from timeline_sync.settings import config
+from timeline_sync.utils import parse_time, time_to_str, validate_pin
+from tests import utils as stubs
+from tests.utils import API_KEY, stub_upstream
+
+APP_UUID = uuid.UUID(stubs.APP_UUID)
+
+
+def pin_json(pin_id, rng, title='Benchmark'):
+    pin_time = datetime.datetime.utcnow() + datetime.timedelta(hours=rng.randint(1, 24 * 30))
+    return {
+        'id': pin_id,
+        'time': time_to_str(pin_time),
+        'duration': rng.choice([15, 30, 60]),
+        'layout': {'type': 'genericPin', 'title': title, 'body': 'Seeded by benchmarks.suite',
+                   'tinyIcon': 'system://images/NOTIFICATION_FLAG'},
+        'reminders': [{'time': time_to_str(pin_time - datetime.timedelta(minutes=15)),
+                       'layout': {'type': 'genericReminder', 'title': title, 'tinyIcon': 'system://images/NOTIFICATION_FLAG'}}],
+        'actions': [{'type': 'openWatchApp', 'title': 'Open', 'launchCode': rng.randint(0, 100)}],
+    }
+
+
+def glance_json():
+    expiration = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    return {'slices': [{'layout': {'icon': 'system://images/NOTIFICATION_FLAG', 'subtitleTemplateString': 'Benchmark'},
+                        'expirationTime': time_to_str(expiration)}]}
+
+
+def seed(args, rng):
+    for first_user in range(1, args.users + 1, 100):
+        users = range(first_user, min(first_user + 100, args.users + 1))
+        pins_values = [TimelinePin.values_from_json(pin_json(f'pin-{n}', rng), APP_UUID, user_id, f'uuid:{APP_UUID}', 'web')
+                       for user_id in users for n in range(args.pins_per_user)]
+        guids = upsert_pins(pins_values)
+        write_pin_events([(user_id, guid, 'timeline.pin.create') for (_, user_id, _), guid in guids.items()])
+        for user_id in users:
+            glance = AppGlance.from_json(glance_json()['slices'], APP_UUID, user_id, f'uuid:{APP_UUID}')
+            db.session.add(glance)
+            db.session.flush()
+            write_glance_event(user_id, glance.id)
+        db.session.commit()
+
+    for n in range(args.topics):
+        topic = TimelineTopic(app_uuid=APP_UUID, name=f'topic-{n}')
+        db.session.add(topic)
+        db.session.flush()
+        db.session.execute('INSERT INTO timeline_topic_subscriptions (user_id, topic_id) '
+                           'SELECT g, :topic_id FROM generate_series(1, :subscribers) g',
+                           {'topic_id': topic.id, 'subscribers': args.subscribers})
+    db.session.commit()
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def run_endpoint(client, counter, make_request, requests):
+    latencies = []
+    statements = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        method, url, kwargs = make_request()
+        counter.count = 0
+        start = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        response.get_data()  # Streamed bodies are produced as they are read.
+        latencies.append(time.perf_counter() - start)
+        statements.append(counter.count)
+        assert response.status_code in (200, 304), (url, response.status_code, response.get_data())
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'throughput': requests / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'statements': statistics.mean(statements),
+    }
+
+
+def endpoints(args, rng, client):
+    def user():
+        return rng.randint(1, args.users)
+
+    def full_sync():
+        return 'GET', '/v1/sync', {'headers': {'Authorization': f'Bearer user-{user()}'}}
+
+    sync_urls = {}
+
+    def current_sync():
+        user_id = user()
+        if user_id not in sync_urls:
+            response = client.get('/v1/sync', headers={'Authorization': f'Bearer user-{user_id}'})
+            sync_urls[user_id] = json.loads(response.get_data())['syncURL']
+        return 'GET', sync_urls[user_id], {'headers': {'Authorization': f'Bearer user-{user_id}'}}
+
+    def put_user_pin():
+        pin_id = f'pin-{rng.randrange(args.pins_per_user)}'
+        return 'PUT', f'/v1/user/pins/{pin_id}', {'headers': {'X-User-Token': f'locker-{user()}'},
+                                                  'json': pin_json(pin_id, rng, title=f'Update {rng.random()}')}
+
+    unchanged = pin_json('pin-unchanged', rng)
+
+    def put_unchanged_user_pin():
+        return 'PUT', '/v1/user/pins/pin-unchanged', {'headers': {'X-User-Token': 'locker-1'}, 'json': unchanged}
+
+    def put_shared_pin():
+        pin_id = f'shared-{rng.randrange(100)}'
+        return 'PUT', f'/v1/shared/pins/{pin_id}', {
+            'headers': {'X-API-Key': API_KEY, 'X-Pin-Topics': f'topic-{rng.randrange(args.topics)}'},
+            'json': pin_json(pin_id, rng, title=f'Shared {rng.random()}'),
+        }
+
+    def put_glance():
+        return 'PUT', '/v1/user/glance', {'headers': {'X-User-Token': f'locker-{user()}'}, 'json': glance_json()}
+
+    return {
+        'sync (full)': full_sync,
+        'sync (up to date)': current_sync,
+        'PUT user pin': put_user_pin,
+        'PUT user pin (unchanged)': put_unchanged_user_pin,
+        'PUT shared pin': put_shared_pin,
+        'PUT glance': put_glance,
+    }
+
+
+# A full sync in each encoding a client can ask for.
+ENCODINGS = {
+    'json': {},
+    'json + gzip': {'Accept-Encoding': 'gzip'},
+    'msgpack': {'Accept': MSGPACK_MIMETYPE},
+    'msgpack + gzip': {'Accept': MSGPACK_MIMETYPE, 'Accept-Encoding': 'gzip'},
+}
+
+
+def sync_encodings(args, rng, client, requests):
+    """Bytes sent and CPU spent on full syncs of seeded users, by encoding.
+
+    CPU time is this process's alone, so it leaves out Postgres's share and
+    is mostly encoding.
+    """
+    results = {}
+    for name, headers in ENCODINGS.items():
+        sizes = []
+        cpu_times = []
+        for _ in range(requests):
+            request_headers = dict(headers, Authorization=f'Bearer user-{rng.randint(1, args.users)}')
+            start = time.process_time()
+            response = client.get('/v1/sync', headers=request_headers)
+            body = response.get_data()
+            cpu_times.append(time.process_time() - start)
+            assert response.status_code == 200, (name, response.status_code)
+            sizes.append(len(body))
+        results[name] = {'bytes': statistics.mean(sizes), 'cpu_ms': statistics.mean(cpu_times) * 1000}
+    return results
+
+
+def microbenchmarks(rng, number):
+    pin = pin_json('micro', rng)
+    msec_time = pin['time'][:-1] + '.123Z'
+    values = TimelinePin.values_from_json(pin, APP_UUID, 1, f'uuid:{APP_UUID}', 'web')
+    pin_object = TimelinePin(**values)
+    cases = {
+        'parse_time': lambda: parse_time(pin['time']),
+        'parse_time (msec)': lambda: parse_time(msec_time),
+        'validate_pin': lambda: validate_pin('micro', pin),
+        'TimelinePin.to_json': pin_object.to_json,
+    }
+    return {name: min(timeit.repeat(case, number=number, repeat=3)) / number * 1e6 for name, case in cases.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--pins-per-user', type=int, default=50)
+    parser.add_argument('--topics', type=int, default=10)
+    parser.add_argument('--subscribers', type=int, default=1000, help="per topic")
+    parser.add_argument('--requests', type=int, default=200, help="per endpoint")
+    parser.add_argument('--micro-number', type=int, default=10000)
+    parser.add_argument('--reset', action='store_true', help="drop and re-seed the database first")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--baseline', help="compare against results from this JSON file")
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    upstream.request = stub_upstream
+    config['RATE_LIMIT_BACKEND'] = 'off'
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+            db.create_all()
+            start = time.perf_counter()
+            seed(args, rng)
+            print(f"Seeded in {time.perf_counter() - start:.1f}s")
+
+        counter = StatementCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+        client = app.test_client()
+        results = {
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+            'time': datetime.datetime.utcnow().isoformat(),
+            'endpoints': {name: run_endpoint(client, counter, make_request, args.requests)
+                          for name, make_request in endpoints(args, rng, client).items()},
+            'sync_encodings': sync_encodings(args, rng, client, args.requests),
+            'micro_us': microbenchmarks(rng, args.micro_number),
+        }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(f"{'endpoint':<26} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'SQL/req':>8}")
+    for name, result in results['endpoints'].items():
+        line = f"{name:<26} {result['throughput']:9.1f} {result['p50_ms']:9.2f} {result['p99_ms']:9.2f} {result['statements']:8.1f}"
+        if baseline and name in baseline['endpoints']:
+            line += f"  p50 {result['p50_ms'] / baseline['endpoints'][name]['p50_ms']:5.2f}x baseline"
+        print(line)
+    for name, encoding in results['sync_encodings'].items():
+        line = f"sync, {name:<20} {encoding['bytes']:9.0f} B {encoding['cpu_ms']:9.2f} ms CPU"
+        if baseline and name in baseline.get('sync_encodings', {}):
+            line += f"  {encoding['cpu_ms'] / baseline['sync_encodings'][name]['cpu_ms']:5.2f}x baseline"
+        print(line)
+    for name, micro in results['micro_us'].items():
+        line = f"{name:<26} {micro:9.2f} µs"
+        if baseline and name in baseline['micro_us']:
+            line += f"  {micro / baseline['micro_us'][name]:5.2f}x baseline"
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
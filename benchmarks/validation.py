@@ -0,0 +1,115 @@
+"""Compare the single-pass pin and glance validators with the old ones.
+
+Needs only the app's settings, not a database behind them:
+
+    DATABASE_URL=postgresql://localhost/unused python -m benchmarks.validation
+"""
+import argparse
+import datetime
+import timeit
+
+from timeline_sync.utils import ISO_FORMAT, ISO_FORMAT_MSEC, time_valid, validate_glance, validate_pin
+
+
+def legacy_parse_time(time_str):
+    try:
+        return datetime.datetime.strptime(time_str, ISO_FORMAT)
+    except ValueError:
+        pass
+
+    return datetime.datetime.strptime(time_str, ISO_FORMAT_MSEC)
+
+
+def legacy_pin_valid(pin_id, pin_json):
+    # What pin_valid() used to be, less the beeline fields.
+    try:
+        if pin_json is None or pin_json.get('id') != pin_id:
+            return False
+        if not time_valid(legacy_parse_time(pin_json['time'])):
+            return False
+        if 'createNotification' in pin_json and 'time' in pin_json['createNotification']:
+            return False
+        if 'updateNotification' in pin_json and not time_valid(legacy_parse_time(pin_json['updateNotification']['time'])):
+            return False
+        if 'reminders' in pin_json:
+            if len(pin_json['reminders']) > 3:
+                return False
+            for reminder in pin_json['reminders']:
+                if not time_valid(legacy_parse_time(reminder['time'])):
+                    return False
+    except (KeyError, ValueError, TypeError):
+        return False
+    return True
+
+
+def legacy_pin(pin_id, pin_json):
+    # Validation, and then TimelinePin.content_from_json() parsing it again.
+    if not legacy_pin_valid(pin_id, pin_json):
+        return None
+    return {
+        'time': legacy_parse_time(pin_json['time']),
+        'duration': pin_json.get('duration'),
+        'create_notification': pin_json.get('createNotification'),
+        'update_notification': pin_json.get('updateNotification'),
+        'layout': pin_json['layout'],
+        'reminders': pin_json.get('reminders'),
+        'actions': pin_json.get('actions'),
+    }
+
+
+def legacy_glance(glance_json):
+    if glance_json is None or 'slices' not in glance_json:
+        return None
+    for glance_slice in glance_json['slices']:
+        if 'expirationTime' in glance_slice:
+            legacy_parse_time(glance_slice['expirationTime'])
+    # AppGlanceSlice.from_json() parsing it again.
+    return [{'layout': glance_slice['layout'],
+             'expiration': legacy_parse_time(glance_slice['expirationTime']) if 'expirationTime' in glance_slice else None}
+            for glance_slice in glance_json['slices']]
+
+
+def make_pin(msec):
+    def stamp(delta):
+        value = datetime.datetime.utcnow() + delta
+        return value.strftime(ISO_FORMAT_MSEC)[:-4] + 'Z' if msec else value.strftime(ISO_FORMAT)
+
+    return {
+        'id': 'bench-pin',
+        'time': stamp(datetime.timedelta(hours=2)),
+        'duration': 60,
+        'layout': {'type': 'calendarPin', 'title': 'Standup', 'body': 'Room 4', 'tinyIcon': 'system://images/TIMELINE_CALENDAR'},
+        'updateNotification': {'time': stamp(datetime.timedelta()), 'layout': {'type': 'genericNotification', 'title': 'Moved'}},
+        'reminders': [{'time': stamp(datetime.timedelta(hours=1, minutes=45)), 'layout': {'type': 'genericReminder', 'title': 'Standup'}}
+                      for _ in range(3)],
+        'actions': [{'type': 'openWatchApp', 'title': 'Open', 'launchCode': 1}],
+    }
+
+
+def make_glance(msec):
+    expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    expiration = expiration.strftime(ISO_FORMAT_MSEC)[:-4] + 'Z' if msec else expiration.strftime(ISO_FORMAT)
+    return {'slices': [{'layout': {'icon': 'system://images/HOTEL_RESERVATION', 'subtitleTemplateString': 'Check in'},
+                        'expirationTime': expiration} for _ in range(4)]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    for msec in (False, True):
+        pin, glance = make_pin(msec), make_glance(msec)
+        label = 'with msec' if msec else 'no msec'
+        for name, legacy, current in (
+                ('pin', lambda: legacy_pin('bench-pin', pin), lambda: validate_pin('bench-pin', pin)),
+                ('glance', lambda: legacy_glance(glance), lambda: validate_glance(glance))):
+            assert legacy() == current()
+            legacy_time = min(timeit.repeat(legacy, number=args.number, repeat=3)) / args.number
+            current_time = min(timeit.repeat(current, number=args.number, repeat=3)) / args.number
+            print(f"{name:>6} ({label:>9}): old {legacy_time * 1e6:6.1f} µs, new {current_time * 1e6:6.1f} µs, "
+                  f"{legacy_time / current_time:4.1f}x")
+
+
+if __name__ == '__main__':
+    main()
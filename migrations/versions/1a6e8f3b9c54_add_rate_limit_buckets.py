@@ -0,0 +1,29 @@
+"""Add shared rate limit buckets.
+
+Revision ID: 1a6e8f3b9c54
+Revises: f47b2e9c0d15
+Create Date: 2026-10-18 17:40:29.816533
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a6e8f3b9c54'
+down_revision = 'f47b2e9c0d15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rate_limit_buckets',
+    sa.Column('key', sa.String(length=80), nullable=False),
+    sa.Column('tokens', sa.Float(), nullable=False),
+    sa.Column('update_time', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('rate_limit_buckets')
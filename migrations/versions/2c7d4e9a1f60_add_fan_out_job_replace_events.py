@@ -0,0 +1,24 @@
+"""Let fan-out jobs leave subscribers' existing events alone, for unchanged pins.
+
+Revision ID: 2c7d4e9a1f60
+Revises: 1a6e8f3b9c54
+Create Date: 2026-10-18 21:12:44.305817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c7d4e9a1f60'
+down_revision = '1a6e8f3b9c54'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('fan_out_jobs', sa.Column('replace_events', sa.Boolean(), server_default='true', nullable=False))
+
+
+def downgrade():
+    op.drop_column('fan_out_jobs', 'replace_events')
@@ -0,0 +1,24 @@
+"""Add a (user_id, id) index on user_timeline for keyset-paginated sync.
+
+Revision ID: 3c9a7e1f4b52
+Revises: de2ba13df54d
+Create Date: 2026-10-18 10:12:41.118260
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9a7e1f4b52'
+down_revision = 'de2ba13df54d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('user_timeline_userid_id', 'user_timeline', ['user_id', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('user_timeline_userid_id', table_name='user_timeline')
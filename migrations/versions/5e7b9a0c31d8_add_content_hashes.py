@@ -0,0 +1,26 @@
+"""Add content hashes to pins and glances, to skip rewriting unchanged ones.
+
+Revision ID: 5e7b9a0c31d8
+Revises: a4d2c8e65f13
+Create Date: 2026-10-18 13:02:45.190337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7b9a0c31d8'
+down_revision = 'a4d2c8e65f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('timeline_pins', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.add_column('app_glances', sa.Column('content_hash', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    op.drop_column('app_glances', 'content_hash')
+    op.drop_column('timeline_pins', 'content_hash')
@@ -0,0 +1,24 @@
+"""Index rate limit buckets by when they were last touched, for the expiry worker.
+
+Revision ID: 7e3a9d2c5b18
+Revises: 2c7d4e9a1f60
+Create Date: 2026-10-18 22:31:07.582641
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e3a9d2c5b18'
+down_revision = '2c7d4e9a1f60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('rate_limit_bucket_update_time_index', 'rate_limit_buckets', ['update_time'], unique=False)
+
+
+def downgrade():
+    op.drop_index('rate_limit_bucket_update_time_index', table_name='rate_limit_buckets')
@@ -0,0 +1,40 @@
+"""Add a queue of shared pin fan-out jobs.
+
+Revision ID: 8b1f0c6d2e97
+Revises: 3c9a7e1f4b52
+Create Date: 2026-10-18 11:03:27.402915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '8b1f0c6d2e97'
+down_revision = '3c9a7e1f4b52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('fan_out_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('pin_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('type', sa.String(length=32), nullable=False),
+    sa.Column('topic_ids', postgresql.ARRAY(sa.Integer()), nullable=False),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('last_user_id', sa.Integer(), nullable=True),
+    sa.Column('events_written', sa.Integer(), nullable=False),
+    sa.Column('create_time', sa.DateTime(), nullable=False),
+    sa.Column('update_time', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['pin_id'], ['timeline_pins.guid'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('fan_out_job_status_index', 'fan_out_jobs', ['status', 'id'], unique=False)
+    op.create_index(op.f('ix_fan_out_jobs_pin_id'), 'fan_out_jobs', ['pin_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_fan_out_jobs_pin_id'), table_name='fan_out_jobs')
+    op.drop_index('fan_out_job_status_index', table_name='fan_out_jobs')
+    op.drop_table('fan_out_jobs')
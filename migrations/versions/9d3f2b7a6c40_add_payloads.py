@@ -0,0 +1,26 @@
+"""Store pins' and glances' encoded payloads alongside them.
+
+Revision ID: 9d3f2b7a6c40
+Revises: c61e4f8a9b27
+Create Date: 2026-10-18 15:02:37.114209
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3f2b7a6c40'
+down_revision = 'c61e4f8a9b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('timeline_pins', sa.Column('payload', sa.Text(), nullable=True))
+    op.add_column('app_glances', sa.Column('payload', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('app_glances', 'payload')
+    op.drop_column('timeline_pins', 'payload')
@@ -0,0 +1,34 @@
+"""Add a unique index on shared pins, so that they can be upserted.
+
+Revision ID: a4d2c8e65f13
+Revises: 8b1f0c6d2e97
+Create Date: 2026-10-18 12:20:09.771204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d2c8e65f13'
+down_revision = '8b1f0c6d2e97'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # timeline_pin_appuuid_uid_pinid_index never caught duplicate shared pins,
+    # since their user_id is NULL.  Keep the most recently updated of each.
+    op.execute("""
+        DELETE FROM timeline_pins p
+        USING timeline_pins newer
+        WHERE p.user_id IS NULL AND newer.user_id IS NULL
+          AND p.app_uuid = newer.app_uuid AND p.id = newer.id
+          AND (p.update_time, p.guid) < (newer.update_time, newer.guid)
+    """)
+    op.create_index('timeline_pin_appuuid_pinid_shared_index', 'timeline_pins', ['app_uuid', 'id'], unique=True,
+                    postgresql_where=sa.text('user_id IS NULL'))
+
+
+def downgrade():
+    op.drop_index('timeline_pin_appuuid_pinid_shared_index', table_name='timeline_pins')
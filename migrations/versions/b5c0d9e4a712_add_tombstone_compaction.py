@@ -0,0 +1,36 @@
+"""Track when pins were deleted, and how far each user's timeline is compacted.
+
+Revision ID: b5c0d9e4a712
+Revises: e83a1c5d7f29
+Create Date: 2026-10-18 16:21:44.903175
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5c0d9e4a712'
+down_revision = 'e83a1c5d7f29'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('timeline_pins', sa.Column('deleted_time', sa.DateTime(), nullable=True))
+    op.create_index('timeline_pin_deleted_time_index', 'timeline_pins', ['deleted_time'], unique=False,
+                    postgresql_where=sa.text('deleted_time IS NOT NULL'))
+    op.add_column('user_sync_versions', sa.Column('compacted_id', sa.Integer(), nullable=True))
+    # Pins deleted before now left no record of when; their grace period
+    # starts today.  A pin anybody still has a create event for is live.
+    op.execute("""
+        UPDATE timeline_pins SET deleted_time = now() AT TIME ZONE 'utc'
+        WHERE guid IN (SELECT pin_id FROM user_timeline WHERE type = 'timeline.pin.delete')
+        AND NOT EXISTS (SELECT 1 FROM user_timeline WHERE pin_id = timeline_pins.guid AND type = 'timeline.pin.create')
+    """)
+
+
+def downgrade():
+    op.drop_column('user_sync_versions', 'compacted_id')
+    op.drop_index('timeline_pin_deleted_time_index', table_name='timeline_pins')
+    op.drop_column('timeline_pins', 'deleted_time')
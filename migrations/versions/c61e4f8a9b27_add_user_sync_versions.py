@@ -0,0 +1,39 @@
+"""Add per-user sync versions, so that up-to-date syncs can skip the timeline.
+
+Revision ID: c61e4f8a9b27
+Revises: 5e7b9a0c31d8
+Create Date: 2026-10-18 14:11:52.603318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c61e4f8a9b27'
+down_revision = '5e7b9a0c31d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_sync_versions',
+    sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('timeline_id', sa.Integer(), nullable=True),
+    sa.Column('glance_id', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    # Anything written by the old code between this and the deploy gets
+    # picked up by running models.backfill_user_sync_versions() afterwards.
+    op.execute("""
+        INSERT INTO user_sync_versions (user_id, timeline_id, glance_id)
+        SELECT user_id, max(timeline_id), max(glance_id) FROM (
+            SELECT user_id, max(id) AS timeline_id, NULL::integer AS glance_id FROM user_timeline WHERE user_id IS NOT NULL GROUP BY user_id
+            UNION ALL
+            SELECT user_id, NULL::integer, max(id) FROM app_glances WHERE user_id IS NOT NULL GROUP BY user_id
+        ) latest GROUP BY user_id
+    """)
+
+
+def downgrade():
+    op.drop_table('user_sync_versions')
@@ -0,0 +1,28 @@
+"""Index the expiry predicates, and user_timeline.pin_id for the cascades.
+
+Revision ID: e83a1c5d7f29
+Revises: 9d3f2b7a6c40
+Create Date: 2026-10-18 15:48:06.527331
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e83a1c5d7f29'
+down_revision = '9d3f2b7a6c40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('timeline_pin_time_index', 'timeline_pins', ['time'], unique=False)
+    op.create_index('app_glance_slice_expiration_index', 'app_glance_slices', ['expiration'], unique=False)
+    op.create_index('user_timeline_pinid', 'user_timeline', ['pin_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('user_timeline_pinid', table_name='user_timeline')
+    op.drop_index('app_glance_slice_expiration_index', table_name='app_glance_slices')
+    op.drop_index('timeline_pin_time_index', table_name='timeline_pins')
@@ -0,0 +1,44 @@
+"""Log glance events in user_timeline alongside pin events.
+
+Revision ID: f47b2e9c0d15
+Revises: b5c0d9e4a712
+Create Date: 2026-10-18 16:58:13.270842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f47b2e9c0d15'
+down_revision = 'b5c0d9e4a712'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user_timeline', sa.Column('glance_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('user_timeline_glance_id_fkey', 'user_timeline', 'app_glances', ['glance_id'], ['id'], ondelete='CASCADE')
+    op.create_index('user_timeline_glanceid', 'user_timeline', ['glance_id'], unique=False,
+                    postgresql_where=sa.text('glance_id IS NOT NULL'))
+    # Anything written by the old code between this and the deploy gets
+    # picked up by running models.backfill_glance_events() afterwards.
+    op.execute("""
+        WITH events AS (
+            INSERT INTO user_timeline (user_id, type, glance_id)
+            SELECT user_id, 'appglance.slice.create', id FROM app_glances
+            WHERE user_id IS NOT NULL
+            ORDER BY id
+            RETURNING user_id, id
+        )
+        INSERT INTO user_sync_versions (user_id, timeline_id)
+        SELECT user_id, max(id) FROM events GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET timeline_id = GREATEST(user_sync_versions.timeline_id, excluded.timeline_id)
+    """)
+
+
+def downgrade():
+    op.execute("DELETE FROM user_timeline WHERE glance_id IS NOT NULL")
+    op.drop_index('user_timeline_glanceid', table_name='user_timeline')
+    op.drop_constraint('user_timeline_glance_id_fkey', 'user_timeline', type_='foreignkey')
+    op.drop_column('user_timeline', 'glance_id')
@@ -1,11 +1,13 @@
 from os import environ
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from timeline_sync import app, nightly_maintenance
-
-app.run(environ.get("HOST", "127.0.0.1"), environ.get("PORT", 5000), debug=True)
+from timeline_sync import app, expiry_worker, fan_out_worker
 
 # Use BackgroundScheduler in Docker mode; on prod, we call in directly from Zappa.
+# It has to start before app.run(), which does not return.
 scheduler = BackgroundScheduler(daemon=True)
-scheduler.add_job(timeline_sync.nightly_maintenance, 'cron', [], hour=4, minute=0)  # Runs every day at 4 AM
+scheduler.add_job(expiry_worker, 'interval', [], minutes=10)
+scheduler.add_job(fan_out_worker, 'interval', [], seconds=10)
 scheduler.start()
+
+app.run(environ.get("HOST", "127.0.0.1"), environ.get("PORT", 5000), debug=True)
@@ -0,0 +1,31 @@
+"""The tests need a scratch Postgres database, which gets its tables dropped
+and created again for each test:
+
+    TEST_DATABASE_URL=postgresql://localhost/timeline_test python -m pytest tests
+
+Without one, they are skipped.
+"""
+import os
+
+import pytest
+
+if os.environ.get('TEST_DATABASE_URL'):
+    os.environ['DATABASE_URL'] = os.environ['TEST_DATABASE_URL']
+    os.environ.setdefault('RATE_LIMIT_BACKEND', 'off')
+else:
+    collect_ignore_glob = ['test_*.py']
+
+
+@pytest.fixture
+def client(monkeypatch):
+    from timeline_sync import app, upstream
+    from timeline_sync.models import db, topic_cache
+    from .utils import stub_upstream
+
+    monkeypatch.setattr(upstream, 'request', stub_upstream)
+    topic_cache.clear()  # Its ids are from whatever the database held before.
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield app.test_client()
+        db.session.remove()
@@ -0,0 +1,14 @@
+"""Batch endpoints give every item a result of its own."""
+from .utils import pin_json
+
+
+def test_user_pins_batch_rejects_malformed_items_one_by_one(client):
+    response = client.put('/v1/user/pins', headers={'X-User-Token': 'locker-1'}, json={'pins': [
+        {'pin': pin_json('good')},
+        {'pin': pin_json('numeric-token'), 'userToken': 123},
+        'not an item',
+        {'pin': pin_json('no-token'), 'userToken': None},
+        {'pin': pin_json('other-user'), 'userToken': 'locker-2'},
+    ]})
+    assert response.status_code == 200
+    assert [result['status'] for result in response.get_json()['results']] == [200, 400, 400, 410, 200]
@@ -0,0 +1,31 @@
+"""Expiry keeps what syncs read consistent."""
+import datetime
+
+from timeline_sync import app
+from timeline_sync.models import db, AppGlance, RateLimitBucket, delete_expired_pins
+
+from .utils import count_sync_queries, glance_json, sync
+
+
+def test_expired_slices_leave_glance_payloads_stored(client):
+    glance = glance_json(minutes=60)
+    glance['slices'].insert(0, glance_json(minutes=-1)['slices'][0])
+    glance['slices'][0]['layout'] = {'subtitleTemplateString': 'Expired'}
+    assert client.put('/v1/user/glance', headers={'X-User-Token': 'locker-1'}, json=glance).status_code == 200
+    assert client.put('/v1/user/glance', headers={'X-User-Token': 'locker-2'}, json=glance_json()).status_code == 200
+
+    assert delete_expired_pins(app, 10)['slices'] == 1
+    assert db.session.query(AppGlance.payload).filter(AppGlance.payload.is_(None)).count() == 0
+    updates = sync(client, 1)['updates']
+    assert [update['data']['slices'][0]['layout'] for update in updates] == [{'subtitleTemplateString': 'Test'}]
+    assert count_sync_queries(client, 1)[0] == count_sync_queries(client, 2)[0]
+
+
+def test_refilled_rate_limit_buckets_are_deleted(client):
+    now = datetime.datetime.utcnow()
+    db.session.add(RateLimitBucket(key='app:refilled', tokens=0, update_time=now - datetime.timedelta(days=1)))
+    db.session.add(RateLimitBucket(key='app:draining', tokens=0, update_time=now))
+    db.session.commit()
+
+    assert delete_expired_pins(app, 10)['rate_limit_buckets'] == 1
+    assert [bucket.key for bucket in RateLimitBucket.query] == ['app:draining']
@@ -0,0 +1,15 @@
+"""Statement timing doesn't leak state onto pooled connections."""
+import pytest
+from sqlalchemy.exc import ProgrammingError
+
+from timeline_sync.models import db
+
+
+def test_failed_statements_are_forgotten(client):
+    connection = db.session.connection()
+    for _ in range(3):
+        with pytest.raises(ProgrammingError):
+            with connection.begin_nested():
+                connection.execute('SELECT * FROM no_such_table')
+    connection.execute('SELECT 1')
+    assert connection.info['query_start'] == []
@@ -0,0 +1,33 @@
+"""Request latency covers the whole response, streamed or not."""
+import time
+from unittest import mock
+
+from flask import json
+from prometheus_client import REGISTRY
+
+from .utils import seed_user
+
+
+def sync_latency():
+    labels = {'route': 'api.sync', 'method': 'GET', 'status': '200'}
+    return (REGISTRY.get_sample_value('timeline_request_duration_seconds_count', labels) or 0,
+            REGISTRY.get_sample_value('timeline_request_duration_seconds_sum', labels) or 0)
+
+
+def test_streamed_sync_latency_includes_its_body(client):
+    seed_user(client, 1, pins=2)
+    dumps = json.dumps
+
+    def slow_dumps(*args, **kwargs):
+        time.sleep(0.05)
+        return dumps(*args, **kwargs)
+
+    count, total = sync_latency()
+    with mock.patch('timeline_sync.api.json.dumps', slow_dumps):
+        response = client.get('/v1/sync', headers={'Authorization': 'Bearer user-1'})
+        assert sync_latency() == (count, total)  # Nothing has been streamed yet.
+        assert len(response.get_json()['updates']) == 5
+        response.close()
+    new_count, new_total = sync_latency()
+    assert new_count == count + 1
+    assert new_total - total >= 0.25
@@ -0,0 +1,61 @@
+"""Rate limits charge every token a request uses."""
+import pytest
+
+from timeline_sync import ratelimit
+from timeline_sync.settings import config
+
+from .utils import pin_json
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setitem(config, 'RATE_LIMIT_BACKEND', 'memory')
+    monkeypatch.setattr(ratelimit, 'user_buckets', ratelimit.TokenBuckets('user', 0.001, 3, 100))
+    monkeypatch.setattr(ratelimit, 'app_buckets', ratelimit.TokenBuckets('app', 0.001, 3, 100))
+
+
+def put_user_pins(client, items, **headers):
+    return client.put('/v1/user/pins', headers=headers, json={'pins': items})
+
+
+def test_user_token_runs_out(client, limits):
+    for _ in range(3):
+        assert client.get('/v1/sync', headers={'Authorization': 'Bearer user-1'}).status_code == 200
+    response = client.get('/v1/sync', headers={'Authorization': 'Bearer user-1'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+
+
+def test_batch_items_pay_for_their_own_user_tokens(client, limits):
+    items = [{'pin': pin_json(f'p{n}'), 'userToken': 'locker-5'} for n in range(2)]
+    assert put_user_pins(client, items).status_code == 200
+    assert put_user_pins(client, items).status_code == 429
+
+    # Other tokens, and the header's, have their own buckets.
+    items = [{'pin': pin_json('p'), 'userToken': f'locker-{user_id}'} for user_id in (6, 7)] + [{'pin': pin_json('q')}]
+    assert put_user_pins(client, items, **{'X-User-Token': 'locker-8'}).status_code == 200
+
+
+def test_shared_batches_cost_a_token_a_pin(client, limits):
+    items = [{'pin': pin_json(f'p{n}'), 'topics': ['a']} for n in range(2)]
+    assert client.put('/v1/shared/pins', headers={'X-API-Key': 'test-app'}, json={'pins': items}).status_code == 200
+    assert client.put('/v1/shared/pins', headers={'X-API-Key': 'test-app'}, json={'pins': items}).status_code == 429
+
+
+def test_oversized_batches_cost_one_token(client, limits, monkeypatch):
+    monkeypatch.setitem(config, 'BATCH_MAX_PINS', 2)
+    items = [{'pin': pin_json(f'p{n}')} for n in range(3)]
+    for _ in range(3):
+        assert put_user_pins(client, items, **{'X-User-Token': 'locker-9'}).status_code == 400
+    assert put_user_pins(client, items, **{'X-User-Token': 'locker-9'}).status_code == 429
+
+
+def test_requests_turned_away_by_a_user_token_cost_the_app_nothing(client, limits):
+    pin = pin_json('p')
+    for _ in range(3):
+        assert client.put('/v1/user/pins/p', headers={'X-User-Token': 'locker-1'}, json=pin).status_code == 200
+    for _ in range(3):
+        assert client.put('/v1/shared/pins/p', json=pin,
+                          headers={'X-API-Key': 'test-app', 'X-Pin-Topics': 'a', 'X-User-Token': 'locker-1'}).status_code == 429
+    for _ in range(3):
+        assert client.put('/v1/shared/pins/p', json=pin, headers={'X-API-Key': 'test-app', 'X-Pin-Topics': 'a'}).status_code == 200
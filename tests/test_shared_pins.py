@@ -0,0 +1,101 @@
+"""Shared pins reach their topics' subscribers, and only them."""
+from timeline_sync import app
+from timeline_sync.models import process_fan_out_jobs
+from timeline_sync.settings import config
+
+from .utils import API_KEY, pin_json, put_shared_pin, subscribe, sync
+
+
+def pin_events(client, user_id):
+    return [(update['type'], update['data']['layout']['title']) for update in sync(client, user_id)['updates']]
+
+
+def test_update_drops_events_of_users_who_stopped_following(client):
+    subscribe(client, 1, 'a')
+    subscribe(client, 2, 'a')
+    subscribe(client, 3, 'b')
+    put_shared_pin(client, pin_json('p', title='first'), ['a', 'b'])
+    for user_id in (1, 2, 3):
+        assert pin_events(client, user_id) == [('timeline.pin.create', 'first')]
+
+    subscribe(client, 2, 'a', method='DELETE')
+    put_shared_pin(client, pin_json('p', title='second'), ['a'])
+    assert pin_events(client, 1) == [('timeline.pin.create', 'second')]
+    assert pin_events(client, 2) == []
+    assert pin_events(client, 3) == []
+
+    subscribe(client, 1, 'a', method='DELETE')
+    assert client.delete('/v1/shared/pins/p', headers={'X-API-Key': API_KEY}).status_code == 200
+    assert pin_events(client, 1) == []
+
+
+def test_fan_out_job_drops_events_of_users_who_stopped_following(client, monkeypatch):
+    monkeypatch.setitem(config, 'FANOUT_INLINE_MAX', 1)
+    monkeypatch.setitem(config, 'FANOUT_CHUNK_SIZE', 1)
+    for user_id in (1, 2, 3):
+        subscribe(client, user_id, 'a')
+    subscribe(client, 4, 'b')
+    put_shared_pin(client, pin_json('p', title='first'), ['a'])
+    assert process_fan_out_jobs(app, 10) > 0
+    for user_id in (1, 2, 3):
+        assert pin_events(client, user_id) == [('timeline.pin.create', 'first')]
+
+    put_shared_pin(client, pin_json('p', title='second'), ['b'])
+    process_fan_out_jobs(app, 10)
+    for user_id in (1, 2, 3):
+        assert pin_events(client, user_id) == []
+    assert pin_events(client, 4) == [('timeline.pin.create', 'second')]
+    job = client.get('/v1/shared/pins/p/fan-out', headers={'X-API-Key': API_KEY}).get_json()
+    assert job['status'] == 'done'
+
+
+def test_unchanged_pin_reaches_new_subscribers_only(client, monkeypatch):
+    pin = pin_json('p', title='first')
+    subscribe(client, 1, 'a')
+    put_shared_pin(client, pin, ['a'])
+    cursor = sync(client, 1)['syncURL']
+
+    subscribe(client, 2, 'a')
+    put_shared_pin(client, pin, ['a'])
+    assert pin_events(client, 2) == [('timeline.pin.create', 'first')]
+    assert sync(client, 1, cursor)['updates'] == []
+
+    # Through a fan-out job, too.
+    monkeypatch.setitem(config, 'FANOUT_INLINE_MAX', 1)
+    subscribe(client, 3, 'a')
+    put_shared_pin(client, pin, ['a'])
+    process_fan_out_jobs(app, 10)
+    assert pin_events(client, 3) == [('timeline.pin.create', 'first')]
+    assert sync(client, 1, cursor)['updates'] == []
+
+
+def test_unchanged_pins_in_a_batch_reach_new_subscribers(client):
+    subscribe(client, 1, 'a')
+    pins = [{'pin': pin_json(f'p{n}'), 'topics': ['a']} for n in range(3)]
+    assert client.put('/v1/shared/pins', json={'pins': pins}, headers={'X-API-Key': API_KEY}).status_code == 200
+    cursor = sync(client, 1)['syncURL']
+
+    subscribe(client, 2, 'a')
+    pins[0] = {'pin': pin_json('p0', title='changed'), 'topics': ['a']}
+    assert client.put('/v1/shared/pins', json={'pins': pins}, headers={'X-API-Key': API_KEY}).status_code == 200
+    assert sorted(pin_events(client, 2)) == [('timeline.pin.create', 'changed'), ('timeline.pin.create', 'p1'),
+                                            ('timeline.pin.create', 'p2')]
+    assert pin_events(client, 1) == [('timeline.pin.create', 'p1'), ('timeline.pin.create', 'p2'),
+                                     ('timeline.pin.create', 'changed')]
+    assert [update['data']['layout']['title'] for update in sync(client, 1, cursor)['updates']] == ['changed']
+
+
+def test_fan_out_jobs_run_from_the_task_route(client, monkeypatch):
+    monkeypatch.setitem(config, 'FANOUT_INLINE_MAX', 1)
+    for user_id in (1, 2):
+        subscribe(client, user_id, 'a')
+    put_shared_pin(client, pin_json('p'), ['a'])
+    assert client.post('/tasks/fan-out', headers={'Authorization': 'Bearer worker'}).status_code == 404
+
+    monkeypatch.setitem(config, 'WORKER_TOKEN', 'worker')
+    assert client.post('/tasks/fan-out', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.post('/tasks/fan-out', headers={'Authorization': 'Bearer worker'})
+    assert response.status_code == 200
+    assert response.get_json()['chunks'] > 0
+    for user_id in (1, 2):
+        assert pin_events(client, user_id) == [('timeline.pin.create', 'p')]
@@ -0,0 +1,31 @@
+"""Every encoding of a sync page carries the same page."""
+import gzip
+import json
+
+import msgpack
+
+from timeline_sync.api import MSGPACK_MIMETYPE
+
+from .utils import seed_user
+
+
+def get_sync(client, **headers):
+    response = client.get('/v1/sync', headers=dict(headers, Authorization='Bearer user-1'))
+    assert response.status_code == 200
+    return response
+
+
+def test_encodings_agree(client):
+    seed_user(client, 1, pins=20)
+    page = get_sync(client).get_json()
+
+    response = get_sync(client, **{'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.get_data())) == page
+
+    response = get_sync(client, Accept=MSGPACK_MIMETYPE)
+    assert response.mimetype == MSGPACK_MIMETYPE
+    assert msgpack.unpackb(response.get_data(), raw=False) == page
+
+    response = get_sync(client, Accept=MSGPACK_MIMETYPE, **{'Accept-Encoding': 'gzip'})
+    assert msgpack.unpackb(gzip.decompress(response.get_data()), raw=False) == page
@@ -0,0 +1,53 @@
+"""Paged syncs get every event, a page at a time."""
+from timeline_sync import app
+from timeline_sync.models import compact_tombstones
+from timeline_sync.settings import config
+
+from .utils import pin_json
+
+
+def page_through(client, url, **headers):
+    """Follow syncURL until hasMore runs out; returns the pin ids seen, the last page's response and its syncURL."""
+    headers['Authorization'] = 'Bearer user-1'
+    seen = []
+    while True:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, response.get_data()
+        page = response.get_json()
+        assert not page.get('mustResync')
+        seen += [update['data']['layout']['title'] for update in page['updates']]
+        url = page['syncURL']
+        if not page['hasMore']:
+            return seen, response, url
+
+
+def put_user_pins(client, *pin_ids):
+    for pin_id in pin_ids:
+        assert client.put(f'/v1/user/pins/{pin_id}', headers={'X-User-Token': 'locker-1'},
+                          json=pin_json(pin_id)).status_code == 200
+
+
+def test_etag_of_an_earlier_page_does_not_stop_paging(client):
+    put_user_pins(client, 'a', 'b', 'c')
+    first = client.get('/v1/sync?limit=1', headers={'Authorization': 'Bearer user-1'})
+    etag = first.headers['ETag']
+
+    seen, last, url = page_through(client, first.get_json()['syncURL'], **{'If-None-Match': etag})
+    assert seen == ['b', 'c']
+    assert client.get(url, headers={'Authorization': 'Bearer user-1', 'If-None-Match': last.headers['ETag']}).status_code == 304
+
+
+def test_resync_pages_through_events_older_than_the_compaction_horizon(client, monkeypatch):
+    put_user_pins(client, 'a', 'b', 'c', 'gone')
+    assert client.delete('/v1/user/pins/gone', headers={'X-User-Token': 'locker-1'}).status_code == 200
+    monkeypatch.setitem(config, 'TOMBSTONE_GRACE_DAYS', 0)
+    assert compact_tombstones(app, 10) == 1
+
+    seen, _, url = page_through(client, '/v1/sync?limit=1')
+    assert seen == ['a', 'b', 'c']
+
+    # Later compactions still send clients that are behind them back to the start.
+    put_user_pins(client, 'gone-too')
+    assert client.delete('/v1/user/pins/gone-too', headers={'X-User-Token': 'locker-1'}).status_code == 200
+    assert compact_tombstones(app, 10) == 1
+    assert client.get(url, headers={'Authorization': 'Bearer user-1'}).get_json()['mustResync']
@@ -0,0 +1,17 @@
+"""A sync runs the same number of queries however many items it returns."""
+from .utils import count_sync_queries, seed_user
+
+
+def test_sync_query_count_is_constant(client):
+    seed_user(client, 1, pins=1)
+    seed_user(client, 2, pins=50)
+
+    one_count, one = count_sync_queries(client, 1)
+    many_count, many = count_sync_queries(client, 2)
+
+    assert len(one['updates']) == 3
+    assert len(many['updates']) == 101
+    assert {update['type'] for update in many['updates']} == {'timeline.pin.create', 'appglance.slice.create'}
+    assert all(update['data']['topicKeys'] == ['other', 'topic-2']
+               for update in many['updates'] if update['data'].get('guid') and update['data']['layout']['title'].startswith('shared'))
+    assert many_count == one_count
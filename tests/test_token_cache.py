@@ -0,0 +1,82 @@
+"""User tokens are resolved against the appstore once, and 410s are remembered for a while."""
+import pytest
+
+from timeline_sync import api, cache, upstream
+from timeline_sync.settings import config
+
+from .utils import StubResponse, pin_json, stub_upstream
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def appstore(client, monkeypatch):
+    """Counts locker lookups by token; 'locker-revoked' gets a 410 and 'locker-broken' a 503."""
+    lookups = []
+
+    def request(method, url, **kwargs):
+        if '/locker/by_token/' in url:
+            token = url.rsplit('/', 1)[1]
+            lookups.append(token)
+            if token == 'locker-revoked':
+                return StubResponse(410)
+            if token == 'locker-broken':
+                return StubResponse(503)
+        return stub_upstream(method, url, **kwargs)
+
+    clock = Clock()
+    monkeypatch.setattr(upstream, 'request', request)
+    monkeypatch.setattr(cache, 'time', clock)
+    api.locker_cache.clear()
+    api.app_cache.clear()
+    yield lookups, clock
+    api.locker_cache.clear()
+    api.app_cache.clear()
+
+
+def put_pin(client, token):
+    return client.put('/v1/user/pins/cached', headers={'X-User-Token': token}, json=pin_json('cached')).status_code
+
+
+def test_resolved_tokens_are_cached(client, appstore):
+    lookups, _ = appstore
+    assert put_pin(client, 'locker-1') == 200
+    assert put_pin(client, 'locker-1') == 200
+    assert lookups == ['locker-1']
+    assert api.locker_cache.stats() == {'name': 'locker', 'size': 1, 'maxsize': config['TOKEN_CACHE_SIZE'],
+                                        'hits': 1, 'misses': 1}
+
+
+def test_unknown_tokens_are_cached_until_the_negative_ttl_passes(client, appstore):
+    lookups, clock = appstore
+    assert put_pin(client, 'locker-revoked') == 410
+    clock.now += config['TOKEN_CACHE_NEGATIVE_TTL'] - 1
+    assert put_pin(client, 'locker-revoked') == 410
+    assert lookups == ['locker-revoked']
+
+    clock.now += 1
+    assert put_pin(client, 'locker-revoked') == 410
+    assert lookups == ['locker-revoked', 'locker-revoked']
+
+
+def test_appstore_errors_are_not_cached(client, appstore):
+    lookups, _ = appstore
+    assert put_pin(client, 'locker-broken') == 410
+    assert put_pin(client, 'locker-broken') == 410
+    assert lookups == ['locker-broken', 'locker-broken']
+    assert api.locker_cache.stats()['size'] == 0
+
+
+def test_invalidated_tokens_are_resolved_again(client, appstore):
+    lookups, _ = appstore
+    assert put_pin(client, 'locker-1') == 200
+    api.invalidate_token('locker-1')
+    assert put_pin(client, 'locker-1') == 200
+    assert lookups == ['locker-1', 'locker-1']
+    assert api.locker_cache.stats()['misses'] == 2
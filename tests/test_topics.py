@@ -0,0 +1,18 @@
+"""Topic ids are cached, but never past the topic's deletion."""
+from timeline_sync.models import db, TimelineTopic, resolve_topics
+
+from .utils import APP_UUID
+
+
+def test_deleted_topics_are_resolved_again(client):
+    # The appstore hands app UUIDs out as strings, in whatever case.
+    topic_id = resolve_topics(APP_UUID.upper(), ['a'])['a']
+    db.session.commit()
+    assert resolve_topics(APP_UUID, ['a']) == {'a': topic_id}
+
+    db.session.delete(TimelineTopic.query.get(topic_id))
+    db.session.commit()
+    new_topic_id = resolve_topics(APP_UUID, ['a'])['a']
+    db.session.commit()
+    assert new_topic_id != topic_id
+    assert TimelineTopic.query.get(new_topic_id).name == 'a'
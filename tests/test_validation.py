@@ -0,0 +1,30 @@
+"""Validators reject what they should, and say why."""
+from unittest import mock
+
+from timeline_sync.models import TimelinePin
+from timeline_sync.utils import validate_glance, validate_pin
+
+from .utils import glance_json, pin_json
+
+
+def failure_details(validate, *args):
+    with mock.patch('timeline_sync.utils.beeline') as beeline:
+        assert validate(*args) is None
+    return {call[0][1] for call in beeline.add_context_field.call_args_list}
+
+
+def test_glance_structure():
+    assert validate_glance(glance_json()) is not None
+    assert failure_details(validate_glance, {'slices': 'nope'}) == {'invalid_structure'}
+    assert failure_details(validate_glance, {'slices': ['nope']}) == {'invalid_structure'}
+    assert failure_details(validate_glance, {'slices': [{'layout': 'nope'}]}) == {'invalid_structure'}
+    assert failure_details(validate_glance, {'slices': [{}]}) == {'invalid_structure'}
+    assert failure_details(validate_glance, {'slices': [{'layout': {'body': 'x' * 40000}}]}) == {'too_large'}
+
+
+def test_pin_content_matches_validator():
+    pin = dict(pin_json('p'), duration=30, reminders=[], actions=[])
+    validated = TimelinePin.content_from_json(pin, ['topic'], validate_pin('p', pin))
+    parsed = TimelinePin.content_from_json(pin, ['topic'])
+    del validated['update_time'], parsed['update_time']
+    assert validated == parsed
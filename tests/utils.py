@@ -0,0 +1,83 @@
+import datetime
+
+from sqlalchemy import event
+
+from timeline_sync.models import db
+from timeline_sync.utils import time_to_str
+
+APP_UUID = '6f3b1c52-6c9e-4c47-8a5e-1e2b3c4d5e6f'
+API_KEY = 'test-app'
+
+
+class StubResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+def stub_upstream(method, url, **kwargs):
+    """Answers for the auth service and the appstore.  Access tokens are 'user-<uid>', user tokens 'locker-<uid>'."""
+    if url.endswith('/api/v1/me'):
+        return StubResponse(200, {'uid': int(kwargs['headers']['Authorization'].rsplit('-', 1)[1])})
+    if '/locker/by_token/' in url:
+        return StubResponse(200, {'user_id': int(url.rsplit('-', 1)[1]), 'app_uuid': APP_UUID})
+    if url.endswith(f'/apps/by_token/{API_KEY}'):
+        return StubResponse(200, {'app_uuid': APP_UUID})
+    return StubResponse(404)
+
+
+def pin_json(pin_id, hours=1, title=None):
+    pin_time = datetime.datetime.utcnow() + datetime.timedelta(hours=hours)
+    return {'id': pin_id, 'time': time_to_str(pin_time), 'layout': {'type': 'genericPin', 'title': title or pin_id}}
+
+
+def glance_json(minutes=60):
+    expiration = datetime.datetime.utcnow() + datetime.timedelta(minutes=minutes)
+    return {'slices': [{'layout': {'subtitleTemplateString': 'Test'}, 'expirationTime': time_to_str(expiration)}]}
+
+
+def put_shared_pin(client, pin, topics):
+    response = client.put(f"/v1/shared/pins/{pin['id']}", json=pin,
+                          headers={'X-API-Key': API_KEY, 'X-Pin-Topics': ','.join(topics)})
+    assert response.status_code == 200, response.get_data()
+
+
+def subscribe(client, user_id, topic, method='POST'):
+    response = client.open(f'/v1/user/subscriptions/{topic}', method=method, headers={'X-User-Token': f'locker-{user_id}'})
+    assert response.status_code == 200, response.get_data()
+
+
+def sync(client, user_id, url='/v1/sync'):
+    response = client.get(url, headers={'Authorization': f'Bearer user-{user_id}'})
+    assert response.status_code == 200, response.get_data()
+    return response.get_json()
+
+
+def seed_user(client, user_id, pins):
+    headers = {'X-User-Token': f'locker-{user_id}'}
+    response = client.put('/v1/user/pins', headers=headers,
+                          json={'pins': [{'pin': pin_json(f'pin-{n}', n + 1)} for n in range(pins)]})
+    assert response.status_code == 200
+    subscribe(client, user_id, f'topic-{user_id}')
+    assert client.put('/v1/user/glance', headers=headers, json=glance_json()).status_code == 200
+    for n in range(pins):
+        put_shared_pin(client, pin_json(f'shared-{user_id}-{n}', n + 1), [f'topic-{user_id}', 'other'])
+
+
+def count_sync_queries(client, user_id):
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        response = client.get('/v1/sync', headers={'Authorization': f'Bearer user-{user_id}'})
+        body = response.get_json()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    assert response.status_code == 200
+    return len(statements), body
@@ -1,10 +1,14 @@
-from flask import Flask, request
+from flask import Flask, abort, jsonify, request
 from werkzeug.middleware.proxy_fix import ProxyFix
 from rws_common import honeycomb
+import secrets
+import time
 
 from .settings import config
 from .api import init_api
-from .models import init_app, delete_expired_pins
+from .instrumentation import init_instrumentation
+from .metrics import init_metrics, metrics_response
+from .models import db, init_app, compact_tombstones, delete_expired_pins, process_fan_out_jobs
 
 app = Flask(__name__)
 app.config.update(**config)
@@ -14,6 +18,8 @@ honeycomb.init(app, 'timeline_sync')
 honeycomb.sample_routes['api.sync'] = 10
 
 init_app(app)
+init_instrumentation(app)
+init_metrics(app, db.get_engine(app).pool)
 init_api(app)  # Includes both private (timeline-sync) and public (timeline-api) APIs
 
 @app.route('/heartbeat')
@@ -21,6 +27,50 @@ init_api(app)  # Includes both private (timeline-sync) and public (timeline-api)
 def heartbeat():
     return 'ok'
 
-def nightly_maintenance():
-    delete_expired_pins(app)
+@app.route('/metrics')
+@app.route('/timeline-sync/metrics')
+def metrics():
+    return metrics_response()
+
+def expiry_worker():
+    # Expiry comes first; compaction gets whatever time is left of the budget.
+    deadline = time.monotonic() + config['EXPIRY_TIME_BUDGET']
+    expired = delete_expired_pins(app)
+    expired['deleted_pins'] = compact_tombstones(app, deadline - time.monotonic())
+    return expired
+
+# What schedulers outside this repo know the expiry worker as.
+nightly_maintenance = expiry_worker
+
+def fan_out_worker():
+    return {'chunks': process_fan_out_jobs(app)}
+
+WORKER_TASKS = {'expiry': expiry_worker, 'fan-out': fan_out_worker}
+
+# For deployments with nothing to call the workers directly, such as Cloud
+# Run, where Cloud Scheduler can POST here instead.
+@app.route('/tasks/<task>', methods=['POST'])
+@app.route('/timeline-sync/tasks/<task>', methods=['POST'])
+def run_worker_task(task):
+    if not config['WORKER_TOKEN'] or task not in WORKER_TASKS:
+        abort(404)
+    if not secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {config['WORKER_TOKEN']}"):
+        abort(403)
+    return jsonify(WORKER_TASKS[task]())
+
+@app.cli.command('expiry-worker')
+def expiry_worker_command():
+    """Delete expired pins and glance slices, and compact deleted pins, as they come due, until interrupted."""
+    while True:
+        expired = delete_expired_pins(app)
+        compacted = compact_tombstones(app)
+        if not any(expired.values()) and not compacted:
+            time.sleep(60)
+
+@app.cli.command('fan-out-worker')
+def fan_out_worker_command():
+    """Process queued shared pin fan-out jobs until interrupted."""
+    while True:
+        if process_fan_out_jobs(app) == 0:
+            time.sleep(1)
 
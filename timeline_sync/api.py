@@ -1,32 +1,66 @@
-from flask import Blueprint, jsonify, url_for, request
+from flask import Blueprint, Response, abort, json, jsonify, url_for, request, stream_with_context
+from sqlalchemy import and_, or_, true
 import secrets
 import uuid
-import requests
-from .models import db, SandboxToken, TimelinePin, UserTimeline, TimelineTopic, TimelineTopicSubscription, AppGlance
-from .utils import get_uid, api_error, pin_valid, glance_valid
+from .models import db, SandboxToken, TimelinePin, TimelinePinTopic, UserTimeline, TimelineTopic, TimelineTopicSubscription, AppGlance, \
+    FanOutJob, UserSyncVersion, mark_pin_deleted, publish_pin, record_user_changes, resolve_topics, set_pin_topics, \
+    shared_pin_guids, upsert_pins, write_glance_event, write_pin_events
+from .utils import get_uid, api_error, batch_items, validate_pin, validate_glance, ERROR_CODES
+from .cache import TTLCache
+from .compression import gzip_response
+from .notify import get_listener
+from .ratelimit import check_rate_limits
+from . import upstream
 from .settings import config
 
 import beeline
+import msgpack
+
+MSGPACK_MIMETYPE = 'application/x-msgpack'
 
 api = Blueprint('api', __name__)
+api.before_request(check_rate_limits)
+api.after_request(gzip_response)
 
+# Resolved user tokens and API keys.  The appstore answers these lookups with
+# a 4xx for tokens it does not know about; those are cached (for a shorter
+# time) too, so that a client hammering us with a revoked token does not turn
+# into an appstore request every time.
+locker_cache = TTLCache('locker', config['TOKEN_CACHE_SIZE'], config['TOKEN_CACHE_TTL'])
+app_cache = TTLCache('app', config['TOKEN_CACHE_SIZE'], config['TOKEN_CACHE_TTL'])
+NEGATIVE_CACHE_STATUSES = (404, 410)
+_UNCACHED = object()
 
-def get_locker_info(user_token):
-    if user_token is None:
-        raise ValueError
+
+def _resolve_locker_info(user_token):
     sandbox_token = SandboxToken.query.filter_by(token=user_token).one_or_none()
     if sandbox_token is not None:
-        beeline.add_context_field('user', sandbox_token.user_id)
-        beeline.add_context_field('app_uuid', sandbox_token.app_uuid)
         return sandbox_token.user_id, sandbox_token.app_uuid, f"sandbox-uuid:{sandbox_token.app_uuid}"
-    else:
-        result = requests.get(f"{config['APPSTORE_API_URL']}/api/v1/locker/by_token/{user_token}", headers={"Authorization": f"Bearer {config['SECRET_KEY']}"})
-        if result.status_code != 200:
-            raise ValueError
-        locker_info = result.json()
-        beeline.add_context_field('user', locker_info['user_id'])
-        beeline.add_context_field('app_uuid', locker_info['app_uuid'])
-        return locker_info['user_id'], locker_info['app_uuid'], f"uuid:{locker_info['app_uuid']}"
+
+    result = upstream.get(f"{config['APPSTORE_API_URL']}/api/v1/locker/by_token/{user_token}", headers={"Authorization": f"Bearer {config['SECRET_KEY']}"})
+    if result.status_code in NEGATIVE_CACHE_STATUSES:
+        return None
+    if result.status_code != 200:
+        raise ValueError
+    locker_info = result.json()
+    return locker_info['user_id'], locker_info['app_uuid'], f"uuid:{locker_info['app_uuid']}"
+
+
+def get_locker_info(user_token):
+    if user_token is None:
+        raise ValueError
+    locker_info = locker_cache.get(user_token, _UNCACHED)
+    beeline.add_context_field('timeline.token_cache', 'miss' if locker_info is _UNCACHED else 'hit')
+    if locker_info is _UNCACHED:
+        locker_info = _resolve_locker_info(user_token)
+        locker_cache.set(user_token, locker_info, ttl=None if locker_info is not None else config['TOKEN_CACHE_NEGATIVE_TTL'])
+    if locker_info is None:
+        raise ValueError
+
+    user_id, app_uuid, data_source = locker_info
+    beeline.add_context_field('user', user_id)
+    beeline.add_context_field('app_uuid', app_uuid)
+    return user_id, app_uuid, data_source
 
 
 @api.route('/tokens/sandbox/<app_uuid>')
@@ -50,34 +84,188 @@ def get_sandbox_token(app_uuid):
 @api.route('/sync')
 def sync():
     user_id = get_uid()
-    last_timeline_id = request.args.get('timeline')
-
-    user_timeline = db.session.query(UserTimeline).filter_by(user_id=user_id)
-    if last_timeline_id is not None:
-        user_timeline = user_timeline.filter(UserTimeline.id > last_timeline_id)
-
-    last_timeline = user_timeline.order_by(UserTimeline.id.desc()).first()
-    if last_timeline is not None:
-        last_timeline_id = last_timeline.id
-
-    last_glance_id = request.args.get('glance')
-
-    app_glances = db.session.query(AppGlance).filter_by(user_id=user_id)
-    if last_glance_id is not None:
-        app_glances = app_glances.filter(AppGlance.id > last_glance_id)
-
-    last_glance = app_glances.order_by(AppGlance.id.desc()).first()
-    if last_glance is not None:
-        last_glance_id = last_glance.id
-
-    timeline_updates = [user_timeline_item.to_json() for user_timeline_item in user_timeline.order_by(UserTimeline.id.asc())]
-    glances_updates = [glance.to_json() for glance in app_glances.order_by(AppGlance.id.asc())]
-
-    result = {
-        "updates": timeline_updates + glances_updates,
-        "syncURL": url_for('api.sync', timeline=last_timeline_id, glance=last_glance_id, _external=True)
-    }
-    return jsonify(result)
+    requested_limit = request.args.get('limit', type=int)
+    limit = config['SYNC_PAGE_LIMIT']
+    if requested_limit is not None:
+        limit = max(1, min(requested_limit, limit))
+
+    # Pin and glance events share one log, user_timeline, and the cursor is a
+    # keyset cursor over it: we hand back every event after it, a page at a
+    # time, asking for one extra row so that we know whether there is more
+    # to come.  Pins and glances carry their encoded payloads, so a sync only
+    # has to splice them together; rows written before payloads were stored
+    # have none, and get encoded the old way.
+    last_event_id, horizon = request.args.get('cursor', (None, None), type=_decode_cursor)
+    events = db.session.query(UserTimeline.id, UserTimeline.type, UserTimeline.pin_id, UserTimeline.glance_id,
+                              TimelinePin.payload, AppGlance.payload) \
+        .outerjoin(TimelinePin, UserTimeline.pin_id == TimelinePin.guid) \
+        .outerjoin(AppGlance, UserTimeline.glance_id == AppGlance.id) \
+        .filter(UserTimeline.user_id == user_id)
+
+    # Sync URLs from before the log had glances in it carry a cursor over
+    # pin events and another over glance ids instead.  Those still work, and
+    # the page they get back comes with a cursor of the new kind.
+    legacy = 'cursor' not in request.args and ('timeline' in request.args or 'glance' in request.args)
+    last_glance_id = None
+    if legacy:
+        last_event_id = request.args.get('timeline', type=int)
+        last_glance_id = request.args.get('glance', type=int)
+        events = events.filter(or_(
+            and_(UserTimeline.pin_id.isnot(None), UserTimeline.id > last_event_id if last_event_id is not None else true()),
+            and_(UserTimeline.glance_id.isnot(None), UserTimeline.glance_id > last_glance_id if last_glance_id is not None else true())))
+        beeline.add_context_field('timeline.sync.legacy_cursor', True)
+    elif last_event_id is not None:
+        events = events.filter(UserTimeline.id > last_event_id)
+
+    # Most syncs find nothing new, which the user's sync version tells us
+    # without touching the log.  It also makes for an ETag.
+    version = _sync_version(user_id)
+    wait = min(request.args.get('wait', 0, type=int), config['LONGPOLL_MAX_WAIT'])
+    if wait > 0 and _up_to_date(version, last_event_id, last_glance_id, legacy):
+        version = _wait_for_updates(user_id, last_event_id, last_glance_id, legacy, wait)
+
+    # Clients can ask for the page in MessagePack rather than JSON.
+    packed = request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+    etag = '{}.{}'.format(*version[:2]) + ('.msgpack' if packed else '')
+
+    # Events from before the compaction horizon may be gone, deletes among
+    # them, so a cursor from back then can't be caught up from -- unless the
+    # horizon has not moved since the cursor was handed out, as it won't
+    # have while a resync pages through events older than it.
+    compacted_id = version[2] or 0
+    if last_event_id is not None and compacted_id > max(last_event_id, horizon or 0):
+        beeline.add_context_field('timeline.sync.must_resync', True)
+        return _page_response({
+            "updates": [],
+            "syncURL": url_for('api.sync', limit=requested_limit, _external=True),
+            "hasMore": False,
+            "mustResync": True,
+        }, packed)
+
+    if _up_to_date(version, last_event_id, last_glance_id, legacy):
+        beeline.add_context_field('timeline.sync.up_to_date', True)
+        # The ETag says nothing about the cursor, so it only holds for a
+        # client that has caught up.
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.vary.add('Accept')
+            return response
+        response = _page_response({
+            "updates": [],
+            "syncURL": url_for('api.sync', cursor=_encode_cursor(last_event_id, compacted_id), limit=requested_limit, _external=True),
+            "hasMore": False,
+        }, packed)
+        response.set_etag(etag)
+        return response
+
+    has_more = False
+
+    # Yields each update, encoded as JSON.
+    def updates():
+        nonlocal last_event_id, has_more
+        count = 0
+        for event_id, event_type, pin_guid, glance_id, pin_payload, glance_payload in \
+                events.order_by(UserTimeline.id.asc()).limit(limit + 1).yield_per(config['SYNC_STREAM_BATCH']):
+            if count == limit:
+                has_more = True
+                break
+            if glance_id is not None:
+                payload = glance_payload or json.dumps(AppGlance.query.get(glance_id).to_json()['data'])
+            else:
+                payload = pin_payload or json.dumps(TimelinePin.query.get(pin_guid).to_json())
+            yield f'{{"type": {json.dumps(event_type)}, "data": {payload}}}'
+            last_event_id = event_id
+            count += 1
+
+        # A legacy cursor skipped events it had already seen, which may run
+        # past the last one we sent; the new cursor goes past them too.
+        if legacy and not has_more and version[0] is not None:
+            last_event_id = max(last_event_id or 0, version[0])
+
+    def sync_url():
+        return url_for('api.sync', cursor=_encode_cursor(last_event_id, compacted_id), limit=requested_limit, _external=True)
+
+    if packed:
+        # Stored payloads are JSON, so they have to be decoded to be packed.
+        body = msgpack.packb({
+            "updates": [json.loads(update) for update in updates()],
+            "syncURL": sync_url(),
+            "hasMore": has_more,
+        }, use_bin_type=True)
+        response = Response(body, mimetype=MSGPACK_MIMETYPE)
+    else:
+        # The body is encoded one update at a time as rows come off a
+        # server-side cursor, so a big page never sits in memory as a whole.
+        def generate():
+            yield '{"updates": ['
+            for index, update in enumerate(updates()):
+                yield (',' if index else '') + update
+            yield f'], "syncURL": {json.dumps(sync_url())}, "hasMore": {json.dumps(has_more)}}}'
+
+        response = Response(stream_with_context(generate()), mimetype='application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    return response
+
+
+def _encode_cursor(event_id, horizon):
+    # Opaque to clients, and versioned, so that what is in it can change.
+    # Version 2 added the compaction horizon the cursor was checked against.
+    return f'2.{event_id:x}.{horizon:x}' if event_id is not None else None
+
+
+def _decode_cursor(cursor):
+    """The (event id, compaction horizon) in a cursor; version 1 cursors have no horizon."""
+    cursor_version, _, rest = cursor.partition('.')
+    if cursor_version == '1':
+        return int(rest, 16), None
+    if cursor_version == '2':
+        event_id, horizon = rest.split('.')
+        return int(event_id, 16), int(horizon, 16)
+    raise ValueError(cursor)
+
+
+def _page_response(page, packed):
+    response = Response(msgpack.packb(page, use_bin_type=True), mimetype=MSGPACK_MIMETYPE) if packed else jsonify(page)
+    response.vary.add('Accept')
+    return response
+
+
+def _sync_version(user_id):
+    """The user's (timeline_id, glance_id, compacted_id) from UserSyncVersion."""
+    version = db.session.query(UserSyncVersion.timeline_id, UserSyncVersion.glance_id, UserSyncVersion.compacted_id) \
+        .filter_by(user_id=user_id).first()
+    return tuple(version) if version is not None else (None, None, None)
+
+
+def _up_to_date(version, last_event_id, last_glance_id, legacy):
+    timeline_version, glance_version, _ = version
+    up_to_date = timeline_version is None or (last_event_id is not None and timeline_version <= last_event_id)
+    if legacy:
+        # A legacy cursor has to have caught up with glances on its own, too.
+        up_to_date = up_to_date and (glance_version is None or (last_glance_id is not None and glance_version <= last_glance_id))
+    return up_to_date
+
+
+def _wait_for_updates(user_id, last_event_id, last_glance_id, legacy, wait):
+    """Hold a sync that has nothing to return until something turns up, or `wait` seconds pass.
+
+    Returns the user's sync version as of when we stopped waiting.
+    """
+    listener = get_listener()
+    # Register first, so that a write landing between our check and our wait
+    # still wakes us up.
+    woken = listener.register(user_id)
+    try:
+        version = _sync_version(user_id)
+        if not _up_to_date(version, last_event_id, last_glance_id, legacy):
+            return version
+        db.session.close()  # Don't sit on a database connection while we wait.
+        beeline.add_context_field('timeline.longpoll.woken', woken.wait(wait))
+        return _sync_version(user_id)
+    finally:
+        listener.unregister(user_id, woken)
 
 
 @api.route('/user/pins/<pin_id>', methods=['PUT', 'DELETE'])
@@ -90,68 +278,137 @@ def user_pin(pin_id):
 
     if request.method == 'PUT':
         pin_json = request.json
-        if not pin_valid(pin_id, pin_json):
+        content = validate_pin(pin_id, pin_json)
+        if content is None:
             beeline.add_context_field('timeline.failure.cause', 'pin_valid')
             return api_error(400)
 
-        pin = TimelinePin.query.filter_by(app_uuid=app_uuid, user_id=user_id, id=pin_id).one_or_none()
-        if pin is None:  # create pin
-            pin = TimelinePin.from_json(pin_json, app_uuid, user_id, data_source, 'web', [])
-            if pin is None:
-                beeline.add_context_field('timeline.failure.cause', 'from_json')
-                return api_error(400)
-
-            user_timeline = UserTimeline(user_id=user_id,
-                                         type='timeline.pin.create',
-                                         pin=pin)
-            db.session.add(pin)
-            db.session.add(user_timeline)
-            db.session.commit()
-        else:  # update pin
-            try:
-                pin.update_from_json(pin_json)
-
-                # Clean up old UserTimeline events first.  Note that this
-                # has to be transactional with creating the new one --
-                # which, luckily, it is!
-                UserTimeline.query.filter(UserTimeline.pin == pin).delete()
-
-                user_timeline = UserTimeline(user_id=user_id,
-                                             type='timeline.pin.create',
-                                             pin=pin)
-                db.session.add(pin)
-                db.session.add(user_timeline)
-                db.session.commit()
-            except (KeyError, ValueError):
-                beeline.add_context_field('timeline.failure.cause', 'update_pin')
-                return api_error(400)
+        try:
+            pin_values = TimelinePin.values_from_json(pin_json, app_uuid, user_id, data_source, 'web', content=content)
+        except (KeyError, ValueError):
+            beeline.add_context_field('timeline.failure.cause', 'from_json')
+            return api_error(400)
+
+        # Creating and updating are the same upsert; either way the user's
+        # previous event for the pin, if any, is replaced by a new one.  If
+        # nothing about the pin changed, there is nothing to tell the watch.
+        pin_guids = upsert_pins([pin_values])
+        beeline.add_context_field('timeline.unchanged', not pin_guids)
+        write_pin_events([(user_id, pin_guid, 'timeline.pin.create') for pin_guid in pin_guids.values()])
+        db.session.commit()
 
     elif request.method == 'DELETE':
-        pin = TimelinePin.query.filter_by(app_uuid=app_uuid, user_id=user_id, id=pin_id).first_or_404()
+        pin_guid = mark_pin_deleted(app_uuid, user_id, pin_id)
+        if pin_guid is None:
+            abort(404)
 
-        # No need to post even old create events, since nobody will render
+        # No need to keep even old create events, since nobody will render
         # them, after all.
-        UserTimeline.query.filter(UserTimeline.pin == pin).delete()
-
-        user_timeline = UserTimeline(user_id=user_id,
-                                     type='timeline.pin.delete',
-                                     pin=pin)
-        db.session.add(user_timeline)
+        write_pin_events([(user_id, pin_guid, 'timeline.pin.delete')])
         db.session.commit()
     return 'OK'
 
 
-def get_app_info(timeline_token):
-    if timeline_token is None:
-        raise ValueError
-    result = requests.get(f"{config['APPSTORE_API_URL']}/api/v1/apps/by_token/{timeline_token}", headers={"Authorization": f"Bearer {config['SECRET_KEY']}"})
+def _batch_item_pin(item):
+    pin_json = item.get('pin') if isinstance(item, dict) else None
+    pin_id = pin_json.get('id') if isinstance(pin_json, dict) else None
+    if not isinstance(pin_id, str):
+        return None, None
+    return pin_id, pin_json
+
+
+def _batch_result(pin_id, code=200):
+    result = {'id': pin_id, 'status': code}
+    if code != 200:
+        result.update(ERROR_CODES[code])
+    return result
+
+
+@api.route('/user/pins', methods=['PUT'])
+def user_pins_batch():
+    """Create or update many user pins at once.
+
+    Each item is {"pin": {...}}, optionally with its own "userToken" to use in
+    place of the X-User-Token header, so one request can carry pins for many
+    users.  Every item gets a result of its own, in order.
+    """
+    items = batch_items()
+    if items is None:
+        return api_error(400)
+
+    header_token = request.headers.get('X-User-Token')
+    results = [None] * len(items)
+    accepted = {}  # (app_uuid, user_id, pin_id) -> (index, data_source, pin_json, content); the last write to a pin wins.
+    for index, item in enumerate(items):
+        pin_id, pin_json = _batch_item_pin(item)
+        user_token = item.get('userToken', header_token) if isinstance(item, dict) else None
+        if not isinstance(item, dict) or not isinstance(user_token, (str, type(None))):
+            results[index] = _batch_result(pin_id, 400)
+            continue
+        try:
+            user_id, app_uuid, data_source = get_locker_info(user_token)
+        except ValueError:
+            results[index] = _batch_result(pin_id, 410)
+            continue
+        content = validate_pin(pin_id, pin_json)
+        if content is None:
+            results[index] = _batch_result(pin_id, 400)
+            continue
+        key = (uuid.UUID(str(app_uuid)), user_id, pin_id)
+        if key in accepted:
+            results[accepted[key][0]] = _batch_result(pin_id)
+        accepted[key] = (index, data_source, pin_json, content)
+
+    pins_values = []
+    for (app_uuid, user_id, pin_id), (index, data_source, pin_json, content) in accepted.items():
+        try:
+            pins_values.append(TimelinePin.values_from_json(pin_json, app_uuid, user_id, data_source, 'web', content=content))
+        except (KeyError, ValueError):
+            results[index] = _batch_result(pin_id, 400)
+            continue
+        results[index] = _batch_result(pin_id)
+
+    if pins_values:
+        pin_guids = upsert_pins(pins_values)
+        beeline.add_context_field('timeline.batch.changed', len(pin_guids))
+        write_pin_events([(user_id, pin_guid, 'timeline.pin.create') for (app_uuid, user_id, pin_id), pin_guid in pin_guids.items()])
+        db.session.commit()
+
+    beeline.add_context_field('timeline.batch.size', len(items))
+    beeline.add_context_field('timeline.batch.written', len(pins_values))
+    return jsonify({'results': results})
+
+
+def _resolve_app_info(timeline_token):
+    result = upstream.get(f"{config['APPSTORE_API_URL']}/api/v1/apps/by_token/{timeline_token}", headers={"Authorization": f"Bearer {config['SECRET_KEY']}"})
+    if result.status_code in NEGATIVE_CACHE_STATUSES:
+        return None
     if result.status_code != 200:
         raise ValueError
     app_info = result.json()
-    beeline.add_context_field('app_uuid', app_info['app_uuid'])
     return app_info['app_uuid'], f"uuid:{app_info['app_uuid']}"
 
 
+def get_app_info(timeline_token):
+    if timeline_token is None:
+        raise ValueError
+    app_info = app_cache.get(timeline_token, _UNCACHED)
+    beeline.add_context_field('timeline.token_cache', 'miss' if app_info is _UNCACHED else 'hit')
+    if app_info is _UNCACHED:
+        app_info = _resolve_app_info(timeline_token)
+        app_cache.set(timeline_token, app_info, ttl=None if app_info is not None else config['TOKEN_CACHE_NEGATIVE_TTL'])
+    if app_info is None:
+        raise ValueError
+
+    app_uuid, data_source = app_info
+    beeline.add_context_field('app_uuid', app_uuid)
+    return app_uuid, data_source
+
+
+def invalidate_token(token):
+    locker_cache.invalidate(token)
+    app_cache.invalidate(token)
+
 
 @api.route('/shared/pins/<pin_id>', methods=['PUT', 'DELETE'])
 def shared_pin(pin_id):
@@ -164,79 +421,131 @@ def shared_pin(pin_id):
     if request.method == 'PUT':
         try:
             topic_strings = request.headers.get('X-Pin-Topics').split(",")
-            topics = []
-            for topic_string in topic_strings:
-                topic = TimelineTopic.query.filter_by(app_uuid=app_uuid, name=topic_string).one_or_none()
-
-                if topic is None:
-                    topic = TimelineTopic(app_uuid=app_uuid, name=topic_string)
-                    db.session.add(topic)
-
-                topics.append(topic)
-                pin_json = request.json
+            pin_json = request.json
         except (ValueError, AttributeError):
             return api_error(410)
 
-        if not pin_valid(pin_id, pin_json):
+        content = validate_pin(pin_id, pin_json)
+        if content is None:
             beeline.add_context_field('timeline.failure.cause', 'pin_valid')
             return api_error(400)
 
-        pin = TimelinePin.query.filter_by(app_uuid=app_uuid, id=pin_id, user_id=None).one_or_none()
-        if pin is None:  # create pin
-            pin = TimelinePin.from_json(pin_json, app_uuid, None, data_source, 'web', topics)
-            if pin is None:
-                beeline.add_context_field('timeline.failure.cause', 'from_json')
-                return api_error(400)
-
-            db.session.add(pin)
-
-            for topic in topics:
-                for subscription in topic.subscriptions:
-                    user_timeline = UserTimeline(user_id=subscription.user_id,
-                                                 type='timeline.pin.create',
-                                                 pin=pin)
-                    db.session.add(user_timeline)
-
-            db.session.commit()
-        else:  # update pin
-            try:
-                pin.update_from_json(pin_json)
-
-                # Clean up old UserTimeline events first.  Note that this
-                # has to be transactional with creating the new one --
-                # which, luckily, it is!
-                UserTimeline.query.filter(UserTimeline.pin == pin).delete()
-
-                db.session.add(pin)
-
-                for topic in topics:
-                    for subscription in topic.subscriptions:
-                        user_timeline = UserTimeline(user_id=subscription.user_id,
-                                                     type='timeline.pin.create',
-                                                     pin=pin)
-                        db.session.add(user_timeline)
-
-                db.session.commit()
-            except (KeyError, ValueError):
-                beeline.add_context_field('timeline.failure.cause', 'update_pin')
-                return api_error(400)
+        try:
+            pin_values = TimelinePin.values_from_json(pin_json, app_uuid, None, data_source, 'web', topic_strings, content)
+        except (KeyError, ValueError):
+            beeline.add_context_field('timeline.failure.cause', 'from_json')
+            return api_error(400)
+
+        topic_ids = list(resolve_topics(app_uuid, topic_strings).values())
+        pin_guids = upsert_pins([pin_values], {pin_id: sorted(set(topic_strings))})
+        beeline.add_context_field('timeline.unchanged', not pin_guids)
+        events = []
+        for pin_guid in pin_guids.values():
+            set_pin_topics([(pin_guid, topic_ids)])
+
+            # Subscribers' existing events for the pin get replaced as the new
+            # ones are written; those of users who no longer follow it go.
+            events += publish_pin(pin_guid, topic_ids, 'timeline.pin.create')
+        if not pin_guids:
+            # Nothing changed, but anybody who has subscribed since still
+            # needs the pin.
+            for pin_guid in shared_pin_guids(app_uuid, [pin_id]).values():
+                events += publish_pin(pin_guid, topic_ids, 'timeline.pin.create', replace=False)
+        record_user_changes(timeline_events=events)
+        db.session.commit()
 
     elif request.method == 'DELETE':
-        pin = TimelinePin.query.filter_by(app_uuid=app_uuid, user_id=None, id=pin_id).first_or_404()
+        pin_guid = mark_pin_deleted(app_uuid, None, pin_id)
+        if pin_guid is None:
+            abort(404)
+        topic_ids = [topic_id for topic_id, in db.session.query(TimelinePinTopic.topic_id).filter_by(pin_id=pin_guid)]
+
+        # Each subscriber's create event is replaced by the delete event, and
+        # anybody else's create event just goes.
+        record_user_changes(timeline_events=publish_pin(pin_guid, topic_ids, 'timeline.pin.delete'))
+        db.session.commit()
+    return 'OK'
 
-        # No need to post even old create events, since nobody will render
-        # them, after all.
-        UserTimeline.query.filter(UserTimeline.pin == pin).delete()
 
-        for topic in pin.topics:
-            for subscription in topic.subscriptions:
-                user_timeline = UserTimeline(user_id=subscription.user_id,
-                                             type='timeline.pin.delete',
-                                             pin=pin)
-                db.session.add(user_timeline)
+@api.route('/shared/pins', methods=['PUT'])
+def shared_pins_batch():
+    """Create or update many shared pins at once.
+
+    Each item is {"pin": {...}, "topics": ["topic", ...]}.  Every item gets a
+    result of its own, in order.
+    """
+    try:
+        timeline_token = request.headers.get('X-API-Key')
+        app_uuid, data_source = get_app_info(timeline_token)
+    except ValueError:
+        return api_error(410)
 
+    items = batch_items()
+    if items is None:
+        return api_error(400)
+
+    results = [None] * len(items)
+    accepted = {}  # pin_id -> (index, pin_json, topic names, content); the last write to a pin wins.
+    for index, item in enumerate(items):
+        pin_id, pin_json = _batch_item_pin(item)
+        topic_strings = item.get('topics') if isinstance(item, dict) else None
+        if not isinstance(topic_strings, list) or not all(isinstance(topic_string, str) for topic_string in topic_strings):
+            results[index] = _batch_result(pin_id, 400)
+            continue
+        content = validate_pin(pin_id, pin_json)
+        if content is None:
+            results[index] = _batch_result(pin_id, 400)
+            continue
+        if pin_id in accepted:
+            results[accepted[pin_id][0]] = _batch_result(pin_id)
+        accepted[pin_id] = (index, pin_json, topic_strings, content)
+
+    pins_values = []
+    for pin_id, (index, pin_json, topic_strings, content) in accepted.items():
+        try:
+            pins_values.append(TimelinePin.values_from_json(pin_json, app_uuid, None, data_source, 'web', topic_strings, content))
+        except (KeyError, ValueError):
+            results[index] = _batch_result(pin_id, 400)
+            continue
+        results[index] = _batch_result(pin_id)
+
+    if pins_values:
+        topic_ids = resolve_topics(app_uuid, {name for pin_values in pins_values for name in accepted[pin_values['id']][2]})
+        pin_guids = upsert_pins(pins_values, {pin_id: sorted(set(topic_strings))
+                                              for pin_id, (index, pin_json, topic_strings, content) in accepted.items()})
+        beeline.add_context_field('timeline.batch.changed', len(pin_guids))
+        pin_topics = [(pin_guid, [topic_ids[name] for name in accepted[pin_id][2]])
+                      for (pin_app_uuid, user_id, pin_id), pin_guid in pin_guids.items()]
+        set_pin_topics(pin_topics)
+        events = []
+        for pin_guid, pin_topic_ids in pin_topics:
+            events += publish_pin(pin_guid, pin_topic_ids, 'timeline.pin.create')
+        # Unchanged pins still go to anybody who has subscribed since.
+        changed = {pin_id for (pin_app_uuid, user_id, pin_id) in pin_guids}
+        unchanged = [pin_values['id'] for pin_values in pins_values if pin_values['id'] not in changed]
+        for pin_id, pin_guid in (shared_pin_guids(app_uuid, unchanged).items() if unchanged else ()):
+            events += publish_pin(pin_guid, [topic_ids[name] for name in accepted[pin_id][2]], 'timeline.pin.create',
+                                  replace=False)
+        # All in one go, in user_id order, so as not to deadlock with other publishers.
+        record_user_changes(timeline_events=events)
         db.session.commit()
-    return 'OK'
+
+    beeline.add_context_field('timeline.batch.size', len(items))
+    beeline.add_context_field('timeline.batch.written', len(pins_values))
+    return jsonify({'results': results})
+
+
+@api.route('/shared/pins/<pin_id>/fan-out')
+def shared_pin_fan_out(pin_id):
+    try:
+        timeline_token = request.headers.get('X-API-Key')
+        app_uuid, data_source = get_app_info(timeline_token)
+    except ValueError:
+        return api_error(410)
+
+    pin = TimelinePin.query.filter_by(app_uuid=app_uuid, user_id=None, id=pin_id).first_or_404()
+    job = FanOutJob.query.filter_by(pin_id=pin.guid).order_by(FanOutJob.id.desc()).first_or_404()
+    return jsonify(job.to_json())
 
 
 @api.route('/user/subscriptions')
@@ -263,21 +572,18 @@ def user_subscriptions_manage(topic_string):
     except ValueError:
         return api_error(410)
 
-    topic = TimelineTopic.query.filter_by(app_uuid=app_uuid, name=topic_string).one_or_none()
-    if topic is None:
-        topic = TimelineTopic(app_uuid=app_uuid, name=topic_string)
-        db.session.add(topic)
+    topic_id = resolve_topics(app_uuid, [topic_string])[topic_string]
 
     if request.method == 'POST':
-        subscription = TimelineTopicSubscription.query.filter_by(user_id=user_id, topic=topic).one_or_none()
+        subscription = TimelineTopicSubscription.query.filter_by(user_id=user_id, topic_id=topic_id).one_or_none()
         if subscription is None:
-            subscription = TimelineTopicSubscription(user_id=user_id, topic=topic)
+            subscription = TimelineTopicSubscription(user_id=user_id, topic_id=topic_id)
             db.session.add(subscription)
 
         db.session.commit()
 
     elif request.method == 'DELETE':
-        TimelineTopicSubscription.query.filter_by(user_id=user_id, topic=topic).delete()
+        TimelineTopicSubscription.query.filter_by(user_id=user_id, topic_id=topic_id).delete()
 
         db.session.commit()
 
@@ -293,18 +599,26 @@ def user_app_glance():
         return api_error(410)
 
     glance_json = request.json
-    if not glance_valid(glance_json):
+    slices_values = validate_glance(glance_json)
+    if slices_values is None:
         beeline.add_context_field('glance.failure.cause', 'glance_valid')
         return api_error(400)
 
-    AppGlance.query.filter_by(app_uuid=app_uuid, user_id=user_id).delete()
-
-    glance = AppGlance.from_json(glance_json['slices'], app_uuid, user_id, data_source)
+    glance = AppGlance.from_json(glance_json['slices'], app_uuid, user_id, data_source, slices_values)
     if glance is None:
         beeline.add_context_field('glance.failure.cause', 'from_json')
         return api_error(400)
 
+    current_hash = db.session.query(AppGlance.content_hash).filter_by(app_uuid=app_uuid, user_id=user_id).scalar()
+    if current_hash == glance.content_hash:
+        beeline.add_context_field('glance.unchanged', True)
+        return 'OK'
+
+    # The old glance's event goes with it.
+    AppGlance.query.filter_by(app_uuid=app_uuid, user_id=user_id).delete()
     db.session.add(glance)
+    db.session.flush()
+    write_glance_event(user_id, glance.id)
     db.session.commit()
     return 'OK'
 
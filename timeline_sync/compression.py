@@ -0,0 +1,61 @@
+import gzip
+import zlib
+
+from flask import request
+
+from .settings import config
+
+import beeline
+
+# Anything else is either already compressed or too small to be worth it.
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-msgpack', 'text/plain', 'text/html'}
+
+
+def _gzip_stream(chunks, body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # The server closes our generator; the body's clean-up is ours to run.
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def gzip_response(response):
+    """Gzip `response` if the client accepts it and it is worth compressing.
+
+    Streamed responses are compressed as they go, and always: there is no
+    telling how big they will get, but they are streamed because they are big.
+    """
+    level = config['GZIP_LEVEL']
+    if level == 0 or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers or response.direct_passthrough:
+        return response
+    if request.accept_encodings.quality('gzip') <= 0:
+        return response
+
+    if response.is_streamed:
+        response.response = _gzip_stream(response.iter_encoded(), response.response, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['GZIP_MIN_SIZE']:
+            return response
+        compressed = gzip.compress(data, level)
+        beeline.add_context_field('response.uncompressed_bytes', len(data))
+        beeline.add_context_field('response.compressed_bytes', len(compressed))
+        response.set_data(compressed)
+    response.headers['Content-Encoding'] = 'gzip'
+
+    # The compressed body is a different sequence of bytes from the one any
+    # strong ETag was made for.
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,104 @@
+import logging
+import re
+import time
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .settings import config
+
+import beeline
+
+logger = logging.getLogger(__name__)
+
+_PARAMETER = re.compile(r'%\([^)]*\)s|%s')
+_PARAMETER_LISTS = re.compile(r'\(\?(?:, \?)*\)(?:, \(\?(?:, \?)*\))+|\?(?:, \?)+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """A statement with its parameters and the length of its lists of them taken out, to group it by."""
+    statement = _WHITESPACE.sub(' ', statement).strip()
+    statement = _PARAMETER.sub('?', statement)
+    return _PARAMETER_LISTS.sub('...', statement)[:300]
+
+
+def _request_stats():
+    # Only requests have stats to go in their traces; workers just get the
+    # slow query log.
+    if not has_request_context():
+        return None
+    stats = getattr(g, 'request_stats', None)
+    if stats is None:
+        stats = g.request_stats = {
+            'statements': 0,
+            'db_ms': 0.0,
+            'rows': 0,
+            'slowest_ms': 0.0,
+            'slowest_statement': None,
+            'upstream_calls': 0,
+            'upstream_ms': 0.0,
+        }
+    return stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.monotonic())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = (time.monotonic() - conn.info['query_start'].pop()) * 1000
+    slow = config['SLOW_QUERY_MS'] and elapsed >= config['SLOW_QUERY_MS']
+    if slow:
+        logger.warning("Slow query (%.1f ms): %s", elapsed, fingerprint(statement))
+
+    stats = _request_stats()
+    if stats is None:
+        return
+    stats['statements'] += 1
+    stats['db_ms'] += elapsed
+    stats['rows'] += max(cursor.rowcount, 0)  # -1 for server-side cursors, which count nothing yet.
+    if elapsed > stats['slowest_ms']:
+        stats['slowest_ms'] = elapsed
+        stats['slowest_statement'] = statement
+    if slow:
+        beeline.add_context_field('db.slow_query', True)
+
+
+def _handle_error(context):
+    # A failed statement never gets to after_cursor_execute, so its start
+    # time would sit on the pooled connection forever.
+    if context.connection is not None:
+        started = context.connection.info.get('query_start')
+        if started:
+            started.pop()
+
+
+def record_upstream(duration_ms):
+    stats = _request_stats()
+    if stats is not None:
+        stats['upstream_calls'] += 1
+        stats['upstream_ms'] += duration_ms
+
+
+def _report_request_stats(exc):
+    stats = getattr(g, 'request_stats', None)
+    if stats is None:
+        return
+    beeline.add_context_field('db.statements', stats['statements'])
+    beeline.add_context_field('db.duration_ms', stats['db_ms'])
+    beeline.add_context_field('db.rows', stats['rows'])
+    beeline.add_context_field('db.slowest_ms', stats['slowest_ms'])
+    if stats['slowest_statement'] is not None:
+        beeline.add_context_field('db.slowest_statement', fingerprint(stats['slowest_statement']))
+    beeline.add_context_field('upstream.calls', stats['upstream_calls'])
+    beeline.add_context_field('upstream.total_ms', stats['upstream_ms'])
+
+
+def init_instrumentation(app):
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    # After the body, streamed or not, so that a streamed sync's queries count.
+    app.teardown_request(_report_request_stats)
@@ -0,0 +1,67 @@
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# With several worker processes, prometheus_client keeps each metric in a
+# file under prometheus_multiproc_dir, and a scrape of any one of them adds
+# the lot up.  Gunicorn setups need to call
+# prometheus_client.multiprocess.mark_process_dead() from child_exit, too.
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', os.environ.get('prometheus_multiproc_dir'))
+
+REQUEST_LATENCY = Histogram('timeline_request_duration_seconds', "Time to produce a response, by route",
+                            ['route', 'method', 'status'])
+FAN_OUT_EVENTS = Histogram('timeline_fan_out_events', "Timeline events written per shared pin fan-out", ['mode'],
+                           buckets=(1, 10, 100, 1000, 10000, 100000, 1000000, float('inf')))
+EXPIRED_ROWS = Counter('timeline_expired_rows_total', "Rows deleted by expiry and tombstone compaction", ['kind'])
+CACHE_LOOKUPS = Counter('timeline_cache_lookups_total', "In-process cache lookups", ['cache', 'result'])
+POOL_CHECKED_OUT = Gauge('timeline_db_pool_checked_out', "Database connections in use", multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge('timeline_db_pool_overflow', "Database connections open beyond the pool size", multiprocess_mode='livesum')
+
+
+def _before_request():
+    g.metrics_start = time.monotonic()
+
+
+def _after_request(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    # A streamed body runs after after_request, and its queries with it, so
+    # the time is taken once it is done.
+    start = getattr(g, 'metrics_start', None)
+    if start is not None:
+        status = 500 if exc is not None else getattr(g, 'metrics_status', 500)
+        REQUEST_LATENCY.labels(request.endpoint or 'unmatched', request.method, status).observe(time.monotonic() - start)
+
+
+def _watch_pool(pool):
+    def pool_changed(*args):
+        POOL_CHECKED_OUT.set(pool.checkedout())
+        POOL_OVERFLOW.set(max(pool.overflow(), 0))
+
+    event.listen(pool, 'checkout', pool_changed)
+    event.listen(pool, 'checkin', pool_changed)
+
+
+def metrics_response():
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app, pool):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    if isinstance(pool, QueuePool):
+        _watch_pool(pool)
@@ -1,10 +1,20 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from sqlalchemy import func
-from sqlalchemy.dialects.postgresql import UUID, JSONB
-from .utils import parse_time, time_to_str
+from flask import json
+from sqlalchemy import and_, bindparam, event, exists, func, literal, select, text, tuple_, union_all
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, JSONB, insert
+from sqlalchemy.orm import selectinload
+from .cache import TTLCache
+from .metrics import EXPIRED_ROWS, FAN_OUT_EVENTS
+from .notify import notify_users
+from .settings import config
+from .utils import parse_time, pin_content, time_to_str, content_hash
 import uuid
 import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 
 db = SQLAlchemy()
@@ -21,6 +31,13 @@ class SandboxToken(db.Model):
 db.Index('sandbox_token_uid_appuuid_index', SandboxToken.user_id, SandboxToken.app_uuid, unique=True)
 
 
+TIMELINE_PIN_CONTENT = ('time', 'duration', 'create_notification', 'update_notification', 'layout',
+                        'reminders', 'actions', 'content_hash', 'update_time', 'deleted_time')
+TIMELINE_PIN_JSON_COLUMNS = ('time', 'duration', 'create_notification', 'update_notification', 'layout',
+                             'reminders', 'actions', 'guid', 'data_source', 'source', 'create_time', 'update_time')
+PIN_RETENTION = datetime.timedelta(days=2)  # Pins are kept until two days after their time.
+
+
 class TimelinePin(db.Model):
     __tablename__ = 'timeline_pins'
     guid = db.Column(UUID(as_uuid=True), primary_key=True)
@@ -42,6 +59,11 @@ class TimelinePin(db.Model):
     source = db.Column(db.String(8), nullable=False)
     create_time = db.Column(db.DateTime, nullable=False)
     update_time = db.Column(db.DateTime, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=True)
+    # Set while the pin is deleted and only there for its delete events.
+    deleted_time = db.Column(db.DateTime, nullable=True)
+    # to_json(), already encoded, so that syncs can send it as it is.
+    payload = db.Column(db.Text, nullable=True)
 
     topics = db.relationship('TimelineTopic', secondary='timeline_pin_topic', backref='TimelinePin')
 
@@ -58,65 +80,247 @@ class TimelinePin(db.Model):
                 create_time=datetime.datetime.utcnow(),
                 topics=topics,
             )
-            pin.update_from_json(pin_json)
+            pin.update_from_json(pin_json, [topic.name for topic in topics])
             return pin
         except (KeyError, ValueError):
             return None
 
-    def update_from_json(self, pin_json):
-        self.time = parse_time(pin_json['time'])
-        self.duration = pin_json.get('duration')
-        self.create_notification = pin_json.get('createNotification')
-        self.update_notification = pin_json.get('updateNotification')
-        self.layout = pin_json['layout']
-        self.reminders = pin_json.get('reminders')
-        self.actions = pin_json.get('actions')
-        self.update_time = datetime.datetime.utcnow()
+    @staticmethod
+    def content_from_json(pin_json, topic_names=(), content=None):
+        # One entry for each of TIMELINE_PIN_CONTENT.  The hash covers
+        # everything a watch would see change, topics included, so that
+        # rewriting a pin with the same content can be skipped.  `content`
+        # is what validate_pin() returned for the pin, if it has been checked.
+        content = pin_content(pin_json) if content is None else dict(content)
+        content['content_hash'] = content_hash(dict(content, topics=sorted(set(topic_names))))
+        content['update_time'] = datetime.datetime.utcnow()
+        content['deleted_time'] = None
+        return content
+
+    @classmethod
+    def values_from_json(cls, pin_json, app_uuid, user_id, data_source, source, topic_names=(), content=None):
+        """Column values for a new pin, as taken by upsert_pins()."""
+        values = cls.content_from_json(pin_json, topic_names, content)
+        values.update(
+            guid=uuid.uuid4(),
+            id=pin_json['id'],
+            app_uuid=uuid.UUID(str(app_uuid)),
+            user_id=user_id,
+            data_source=data_source,
+            source=source,
+            create_time=values['update_time'],
+        )
+        return values
+
+    def update_from_json(self, pin_json, topic_names=()):
+        for column, value in self.content_from_json(pin_json, topic_names).items():
+            setattr(self, column, value)
 
     def to_json(self):
+        return self.json_from_values({column: getattr(self, column) for column in TIMELINE_PIN_JSON_COLUMNS},
+                                     [topic.name for topic in self.topics])
+
+    @staticmethod
+    def json_from_values(values, topic_names):
         result = {
-            'time': time_to_str(self.time),
-            'layout': self.layout,
-            'guid': self.guid,
-            'dataSource': self.data_source,
-            'source': self.source,
-            'createTime': time_to_str(self.create_time),
-            'updateTime': time_to_str(self.update_time),
-            'topicKeys': list(map(lambda t: t.name, self.topics))
+            'time': time_to_str(values['time']),
+            'layout': values['layout'],
+            'guid': values['guid'],
+            'dataSource': values['data_source'],
+            'source': values['source'],
+            'createTime': time_to_str(values['create_time']),
+            'updateTime': time_to_str(values['update_time']),
+            'topicKeys': list(topic_names)
         }
 
-        if self.duration is not None:
-            result['duration'] = self.duration
-        if self.create_notification is not None:
-            result['createNotification'] = self.create_notification
-        if self.update_notification is not None:
-            result['updateNotification'] = self.update_notification
-        if self.reminders is not None and len(self.reminders) > 0:
-            result['reminders'] = self.reminders
-        if self.actions is not None and len(self.actions) > 0:
-            result['actions'] = self.actions
+        if values['duration'] is not None:
+            result['duration'] = values['duration']
+        if values['create_notification'] is not None:
+            result['createNotification'] = values['create_notification']
+        if values['update_notification'] is not None:
+            result['updateNotification'] = values['update_notification']
+        if values['reminders'] is not None and len(values['reminders']) > 0:
+            result['reminders'] = values['reminders']
+        if values['actions'] is not None and len(values['actions']) > 0:
+            result['actions'] = values['actions']
 
         return result
 
 
+db.Index('timeline_pin_time_index', TimelinePin.time)
+db.Index('timeline_pin_deleted_time_index', TimelinePin.deleted_time, postgresql_where=TimelinePin.deleted_time.isnot(None))
 db.Index('timeline_pin_appuuid_uid_pinid_index', TimelinePin.app_uuid, TimelinePin.user_id, TimelinePin.id, unique=True)
-
+# NULLs never collide in a unique index, so shared pins need one of their own.
+db.Index('timeline_pin_appuuid_pinid_shared_index', TimelinePin.app_uuid, TimelinePin.id, unique=True,
+         postgresql_where=TimelinePin.user_id.is_(None))
+
+
+def upsert_pins(pins_values, topic_names=None):
+    """Create or update pins from TimelinePin.values_from_json(), keeping their guids.
+
+    Returns key -> guid for the pins written; unchanged ones are left out.
+    """
+    guids = {}
+    payloads = []
+    pins = TimelinePin.__table__
+    pins_values = {(values['app_uuid'], values['user_id'], values['id']): values for values in pins_values}
+    user_pins = [values for values in pins_values.values() if values['user_id'] is not None]
+    shared_pins = [values for values in pins_values.values() if values['user_id'] is None]
+    for batch, conflict_target in ((user_pins, {'index_elements': ['app_uuid', 'user_id', 'id']}),
+                                   (shared_pins, {'index_elements': ['app_uuid', 'id'], 'index_where': pins.c.user_id.is_(None)})):
+        if not batch:
+            continue
+        upsert = insert(pins).values(batch)
+        upsert = upsert.on_conflict_do_update(set_={column: upsert.excluded[column] for column in TIMELINE_PIN_CONTENT},
+                                              where=pins.c.content_hash.is_distinct_from(upsert.excluded.content_hash),
+                                              **conflict_target)
+        upsert = upsert.returning(pins.c.guid, pins.c.app_uuid, pins.c.user_id, pins.c.id,
+                                  pins.c.data_source, pins.c.source, pins.c.create_time)
+        for guid, app_uuid, user_id, pin_id, data_source, source, create_time in db.session.execute(upsert):
+            key = (app_uuid, user_id, pin_id)
+            guids[key] = guid
+            values = dict(pins_values[key], guid=guid, data_source=data_source, source=source, create_time=create_time)
+            pin_topic_names = (topic_names or {}).get(pin_id, ()) if user_id is None else ()
+            payloads.append({'b_guid': guid, 'b_payload': json.dumps(TimelinePin.json_from_values(values, pin_topic_names))})
+
+    if payloads:
+        db.session.execute(pins.update().where(pins.c.guid == bindparam('b_guid')).values(payload=bindparam('b_payload')),
+                           payloads)
+    return guids
+
+
+def shared_pin_guids(app_uuid, pin_ids):
+    """Map an app's shared pin ids to their guids."""
+    pins = TimelinePin.__table__
+    return dict(db.session.execute(select([pins.c.id, pins.c.guid])
+                                   .where(and_(pins.c.app_uuid == uuid.UUID(str(app_uuid)), pins.c.user_id.is_(None),
+                                               pins.c.id.in_(pin_ids)))).fetchall())
+
+
+def mark_pin_deleted(app_uuid, user_id, pin_id):
+    """Prepare a pin for its delete events, returning its guid, or None if there is no such pin.
+
+    The pin row stays, for the delete events to point at, until
+    compact_tombstones() gets to it.  It forgets its content hash, so that
+    putting the same pin back counts as a change.
+    """
+    pins = TimelinePin.__table__
+    user_match = pins.c.user_id.is_(None) if user_id is None else pins.c.user_id == user_id
+    return db.session.execute(pins.update()
+                              .where(and_(pins.c.app_uuid == app_uuid, user_match, pins.c.id == pin_id))
+                              .values(content_hash=None,
+                                      deleted_time=func.coalesce(pins.c.deleted_time, datetime.datetime.utcnow()))
+                              .returning(pins.c.guid)).scalar()
 
 class UserTimeline(db.Model):
+    """Each user's log of pin and glance events, in the order syncs hand them out.
+
+    An event is for either a pin or a glance.  A pin's newer event replaces its
+    older one, under a new id; a glance's goes when the glance is replaced.
+    """
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, index=True)
     type = db.Column(db.String(32))
 
     pin = db.relationship('TimelinePin', lazy=False, uselist=False, backref=db.backref('timelines', passive_deletes=True))
     pin_id = db.Column(UUID(as_uuid=True), db.ForeignKey('timeline_pins.guid', ondelete='CASCADE'))
+    glance = db.relationship('AppGlance', uselist=False, backref=db.backref('timelines', passive_deletes=True))
+    glance_id = db.Column(db.Integer, db.ForeignKey('app_glances.id', ondelete='CASCADE'), nullable=True)
 
     def to_json(self):
         if self.type == 'timeline.pin.create' or self.type == 'timeline.pin.delete':
             return {'type': self.type, 'data': self.pin.to_json()}
+        elif self.type == 'appglance.slice.create':
+            return self.glance.to_json()
         else:
             return None
 
 db.Index('user_timeline_userid_pinid', UserTimeline.user_id, UserTimeline.pin_id, unique = True)
+db.Index('user_timeline_userid_id', UserTimeline.user_id, UserTimeline.id)
+db.Index('user_timeline_pinid', UserTimeline.pin_id)  # For cascading pin deletes.
+db.Index('user_timeline_glanceid', UserTimeline.glance_id, postgresql_where=UserTimeline.glance_id.isnot(None))
+
+
+def write_pin_events(events):
+    """Post (user_id, pin guid, type) timeline events in one statement.
+
+    A user's previous event for the same pin is replaced, under a new id, so
+    that their next sync picks it up.
+    """
+    if not events:
+        return
+    upsert = insert(UserTimeline.__table__) \
+        .values([{'user_id': user_id, 'pin_id': pin_guid, 'type': event_type} for user_id, pin_guid, event_type in events])
+    upsert = upsert.on_conflict_do_update(index_elements=['user_id', 'pin_id'],
+                                          set_={'id': func.nextval('user_timeline_id_seq'),
+                                                'type': upsert.excluded.type})
+    user_timeline = UserTimeline.__table__
+    record_user_changes(timeline_events=db.session.execute(upsert.returning(user_timeline.c.user_id, user_timeline.c.id)))
+
+
+def write_glance_event(user_id, glance_id):
+    """Post a new glance's event to the user's timeline."""
+    user_timeline = UserTimeline.__table__
+    event_id = db.session.execute(insert(user_timeline)
+                                  .values(user_id=user_id, type='appglance.slice.create', glance_id=glance_id)
+                                  .returning(user_timeline.c.id)).scalar()
+    record_user_changes(timeline_events=[(user_id, event_id)], glance_events=[(user_id, glance_id)])
+
+
+class UserSyncVersion(db.Model):
+    """The newest timeline event and glance ids each user has.
+
+    A sync whose cursors are already there has nothing to fetch, and can be
+    answered without looking at user_timeline or app_glances at all.  A sync
+    whose timeline cursor is behind compacted_id, on the other hand, may have
+    missed events that are gone now, and has to start over.
+    """
+    __tablename__ = 'user_sync_versions'
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    timeline_id = db.Column(db.Integer, nullable=True)
+    glance_id = db.Column(db.Integer, nullable=True)
+    compacted_id = db.Column(db.Integer, nullable=True)
+
+
+def record_user_changes(timeline_events=(), glance_events=()):
+    """Bump users' sync versions for new (user_id, id) timeline events and glances, and wake their long-polls."""
+    versions = {}
+    for user_id, timeline_id in timeline_events:
+        version = versions.setdefault(user_id, {'user_id': user_id, 'timeline_id': None, 'glance_id': None})
+        version['timeline_id'] = max(timeline_id, version['timeline_id'] or 0)
+    for user_id, glance_id in glance_events:
+        version = versions.setdefault(user_id, {'user_id': user_id, 'timeline_id': None, 'glance_id': None})
+        version['glance_id'] = max(glance_id, version['glance_id'] or 0)
+    if not versions:
+        return
+
+    # GREATEST skips NULLs, and keeps the version from going backwards when
+    # two writers race.  Going in user_id order keeps them from deadlocking.
+    table = UserSyncVersion.__table__
+    upsert = insert(table).values([versions[user_id] for user_id in sorted(versions)])
+    upsert = upsert.on_conflict_do_update(index_elements=['user_id'],
+                                          set_={'timeline_id': func.greatest(table.c.timeline_id, upsert.excluded.timeline_id),
+                                                'glance_id': func.greatest(table.c.glance_id, upsert.excluded.glance_id)})
+    db.session.execute(upsert)
+    notify_users(db.session, versions.keys())
+
+
+# Meant to be run once in command line, after deploying user_sync_versions, to
+# pick up anything written between the migration and the deploy.
+def backfill_user_sync_versions():
+    db.session.execute("""
+        INSERT INTO user_sync_versions (user_id, timeline_id, glance_id)
+        SELECT user_id, max(timeline_id), max(glance_id) FROM (
+            SELECT user_id, max(id) AS timeline_id, NULL::integer AS glance_id FROM user_timeline WHERE user_id IS NOT NULL GROUP BY user_id
+            UNION ALL
+            SELECT user_id, NULL::integer, max(id) FROM app_glances WHERE user_id IS NOT NULL GROUP BY user_id
+        ) latest GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            timeline_id = GREATEST(user_sync_versions.timeline_id, excluded.timeline_id),
+            glance_id = GREATEST(user_sync_versions.glance_id, excluded.glance_id)
+    """)
+    db.session.commit()
+
 
 class TimelineTopic(db.Model):
     __tablename__ = 'timeline_topics'
@@ -130,6 +334,68 @@ class TimelineTopic(db.Model):
 
 db.Index('timeline_topic_appuuid_name_index', TimelineTopic.app_uuid, TimelineTopic.name, unique=True)
 
+# (app_uuid, name) -> topic id, for topics known to be committed.  app_uuid is
+# always a uuid.UUID here, whatever callers pass in, so that evictions match.
+topic_cache = TTLCache('topic', config['TOPIC_CACHE_SIZE'], config['TOPIC_CACHE_TTL'])
+
+
+def forget_topic(app_uuid, name):
+    """Drop a topic from the cache.  Anything that bulk-deletes topics must call this."""
+    topic_cache.invalidate((uuid.UUID(str(app_uuid)), name))
+
+
+@event.listens_for(TimelineTopic, 'after_delete')
+def _forget_deleted_topic(mapper, connection, topic):
+    forget_topic(topic.app_uuid, topic.name)
+
+
+def resolve_topics(app_uuid, names):
+    """Map topic names to ids for an app, creating any topics that don't exist yet.
+
+    Topics not already cached are looked up, and the missing ones inserted,
+    in one statement; ON CONFLICT makes racing publishers safe.  Only topics
+    that were already committed get cached: one we have just inserted could
+    still vanish if the caller's transaction rolls back.
+    """
+    app_uuid = uuid.UUID(str(app_uuid))
+    topic_ids = {}
+    missing = set()
+    for name in names:
+        topic_id = topic_cache.get((app_uuid, name))
+        if topic_id is None:
+            missing.add(name)
+        else:
+            topic_ids[name] = topic_id
+    if not missing:
+        return topic_ids
+
+    topics = TimelineTopic.__table__
+    missing = sorted(missing)  # A consistent order keeps concurrent inserts from deadlocking.
+    inserted = insert(topics) \
+        .values([{'app_uuid': app_uuid, 'name': name} for name in missing]) \
+        .on_conflict_do_nothing(index_elements=['app_uuid', 'name']) \
+        .returning(topics.c.id, topics.c.name) \
+        .cte('inserted')
+    existing = select([topics.c.id, topics.c.name, literal(True)]) \
+        .where(and_(topics.c.app_uuid == app_uuid, topics.c.name.in_(missing)))
+    resolved = union_all(select([inserted.c.id, inserted.c.name, literal(False)]), existing)
+
+    for topic_id, name, committed in db.session.execute(resolved):
+        topic_ids[name] = topic_id
+        if committed:
+            topic_cache.set((app_uuid, name), topic_id)
+
+    # If another transaction inserted one of the topics while we were at it,
+    # our insert skipped it but the statement's snapshot predates it.
+    if len(topic_ids) < len(set(names)):
+        unresolved = [name for name in missing if name not in topic_ids]
+        for topic_id, name, committed in db.session.execute(existing.where(topics.c.name.in_(unresolved))):
+            topic_ids[name] = topic_id
+            topic_cache.set((app_uuid, name), topic_id)
+
+    return topic_ids
+
+
 class TimelinePinTopic(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
@@ -141,6 +407,21 @@ class TimelinePinTopic(db.Model):
 
 db.Index('timeline_pin_topic_pinid_topicid_index', TimelinePinTopic.pin_id, TimelinePinTopic.topic_id, unique=True)
 
+
+def set_pin_topics(pin_topics):
+    """Set the topics of each (pin guid, topic_ids) pair, without loading the current ones."""
+    db.session.flush()
+    links = TimelinePinTopic.__table__
+    wanted = [(pin_guid, topic_id) for pin_guid, topic_ids in pin_topics for topic_id in topic_ids]
+    stale_links = links.delete().where(links.c.pin_id.in_([pin_guid for pin_guid, topic_ids in pin_topics]))
+    if wanted:
+        stale_links = stale_links.where(~tuple_(links.c.pin_id, links.c.topic_id).in_(wanted))
+        db.session.execute(insert(links)
+                           .values([{'pin_id': pin_guid, 'topic_id': topic_id} for pin_guid, topic_id in wanted])
+                           .on_conflict_do_nothing(index_elements=['pin_id', 'topic_id']))
+    db.session.execute(stale_links)
+
+
 class TimelineTopicSubscription(db.Model):
     __tablename__ = 'timeline_topic_subscriptions'
     id = db.Column(db.Integer, primary_key=True)
@@ -158,18 +439,28 @@ class AppGlance(db.Model):
     data_source = db.Column(db.String(64), nullable=False)
     app_uuid = db.Column(UUID(as_uuid=True), nullable=False)
     create_time = db.Column(db.DateTime, nullable=False)
-    slices = db.relationship('AppGlanceSlice', backref='app_glance')
+    content_hash = db.Column(db.String(64), nullable=True)
+    # The 'data' of to_json(), already encoded.
+    payload = db.Column(db.Text, nullable=True)
+    slices = db.relationship('AppGlanceSlice', backref='app_glance', order_by='AppGlanceSlice.id')
 
     @classmethod
-    def from_json(cls, slices, app_uuid, user_id, data_source):
+    def from_json(cls, slices, app_uuid, user_id, data_source, slices_values=None):
+        # `slices_values` is what validate_glance() returned for the slices.
         try:
+            if slices_values is not None:
+                glance_slices = [AppGlanceSlice(**values) for values in slices_values]
+            else:
+                glance_slices = [AppGlanceSlice.from_json(glance_slice) for glance_slice in slices]
             glance = cls(
                 app_uuid=app_uuid,
                 user_id=user_id,
                 data_source=data_source,
                 create_time=datetime.datetime.utcnow(),
-                slices=[AppGlanceSlice.from_json(glance_slice) for glance_slice in slices],
+                content_hash=content_hash(slices),
+                slices=glance_slices,
             )
+            glance.payload = json.dumps(glance.to_json()['data'])
             return glance
         except (KeyError, ValueError):
             return None
@@ -211,19 +502,360 @@ class AppGlanceSlice(db.Model):
 
         return result
 
-def delete_expired_pins(app):
-    with app.app_context():
-        expiration_time = datetime.datetime.utcnow() - datetime.timedelta(days=2)  # Remove pins older than 2 days
-        expired_pins = db.session.query(TimelinePin).filter(TimelinePin.time < expiration_time)
-        expired_glances = db.session.query(AppGlanceSlice).filter(AppGlanceSlice.expiration < datetime.datetime.utcnow())
+db.Index('app_glance_slice_expiration_index', AppGlanceSlice.expiration)
+
+
+class FanOutJob(db.Model):
+    """A shared pin event being written out to a large topic, a chunk of subscribers at a time."""
+    __tablename__ = 'fan_out_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    pin_id = db.Column(UUID(as_uuid=True), db.ForeignKey('timeline_pins.guid', ondelete='CASCADE'), nullable=False, index=True)
+    type = db.Column(db.String(32), nullable=False)
+    topic_ids = db.Column(ARRAY(db.Integer), nullable=False)
+    replace_events = db.Column(db.Boolean, nullable=False, default=True, server_default='true')
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    last_user_id = db.Column(db.Integer, nullable=True)
+    events_written = db.Column(db.Integer, nullable=False, default=0)
+    create_time = db.Column(db.DateTime, nullable=False)
+    update_time = db.Column(db.DateTime, nullable=False)
+
+    def to_json(self):
+        return {
+            'status': self.status,
+            'type': self.type,
+            'eventsWritten': self.events_written,
+            'createTime': time_to_str(self.create_time),
+            'updateTime': time_to_str(self.update_time),
+        }
+
+db.Index('fan_out_job_status_index', FanOutJob.status, FanOutJob.id)
+FAN_OUT_JOB_OUTSTANDING = ('pending', 'running', 'pruning')
 
-        expired_pins.delete()
-        expired_glances.delete()
+
+class RateLimitBucket(db.Model):
+    """A token bucket shared between workers, when rate limits are kept in Postgres.
+
+    A bucket that has not been touched for long enough to fill up again is
+    no different from none at all, and the expiry worker deletes it.
+    """
+    __tablename__ = 'rate_limit_buckets'
+    key = db.Column(db.String(80), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    update_time = db.Column(db.DateTime, nullable=False)
+
+db.Index('rate_limit_bucket_update_time_index', RateLimitBucket.update_time)
+
+
+def lease_rate_limit_tokens(key, amount, cost, rate, burst):
+    """Take up to `amount` tokens, but at least `cost`, from a shared bucket.
+
+    Returns (tokens granted, tokens that were in the bucket).  Nothing is
+    granted if there were fewer than `cost`.  This runs in a transaction of
+    its own, so that the bucket's row is locked only for as long as it takes.
+    """
+    with db.engine.begin() as connection:
+        available = connection.execute(text("""
+            INSERT INTO rate_limit_buckets AS bucket (key, tokens, update_time)
+            VALUES (:key, :burst, now() AT TIME ZONE 'utc')
+            ON CONFLICT (key) DO UPDATE SET
+                tokens = LEAST(:burst, bucket.tokens + EXTRACT(EPOCH FROM (now() AT TIME ZONE 'utc') - bucket.update_time) * :rate),
+                update_time = now() AT TIME ZONE 'utc'
+            RETURNING tokens
+        """), key=key, burst=burst, rate=rate).scalar()
+        granted = min(amount, available) if available >= cost else 0
+        if granted:
+            connection.execute(text("UPDATE rate_limit_buckets SET tokens = tokens - :granted WHERE key = :key"),
+                               key=key, granted=granted)
+    return granted, available
+
+
+def _topic_subscribers(topic_ids, after_user_id=None):
+    subscribers = select([TimelineTopicSubscription.user_id]) \
+        .where(TimelineTopicSubscription.topic_id.in_(topic_ids)) \
+        .distinct()
+    if after_user_id is not None:
+        subscribers = subscribers.where(TimelineTopicSubscription.user_id > after_user_id)
+    return subscribers
+
+
+def fan_out_pin(pin_guid, topic_ids, event_type, after_user_id=None, up_to_user_id=None, replace=True):
+    """Post a pin event to the subscribers of `topic_ids`, returning the (user_id, id) of each event written."""
+    # Topics created in this request have no id until flushed, but then they
+    # have no subscribers yet either.
+    topic_ids = [topic_id for topic_id in topic_ids if topic_id is not None]
+    if not topic_ids:
+        return []
+    db.session.flush()  # The pin has to exist before events can point at it.
+
+    subscribers = _topic_subscribers(topic_ids, after_user_id)
+    if up_to_user_id is not None:
+        subscribers = subscribers.where(TimelineTopicSubscription.user_id <= up_to_user_id)
+    subscribers = subscribers.column(literal(event_type, type_=db.String)) \
+        .column(literal(pin_guid, type_=UUID(as_uuid=True)))
+
+    events = insert(UserTimeline.__table__).from_select(['user_id', 'type', 'pin_id'], subscribers)
+    if replace:
+        events = events.on_conflict_do_update(index_elements=['user_id', 'pin_id'],
+                                              set_={'id': func.nextval('user_timeline_id_seq'),
+                                                    'type': events.excluded.type})
+    else:
+        events = events.on_conflict_do_nothing(index_elements=['user_id', 'pin_id'])
+    user_timeline = UserTimeline.__table__
+    return db.session.execute(events.returning(user_timeline.c.user_id, user_timeline.c.id)).fetchall()
+
+
+def _prune_pin_events(pin_guid, topic_ids, limit=None):
+    """Delete a shared pin's events for users who follow none of `topic_ids`."""
+    events = UserTimeline.__table__
+    stale = select([events.c.id]).where(events.c.pin_id == pin_guid)
+    if topic_ids:
+        subscriptions = TimelineTopicSubscription.__table__
+        stale = stale.where(~exists().where(and_(subscriptions.c.user_id == events.c.user_id,
+                                                 subscriptions.c.topic_id.in_(topic_ids))))
+    if limit is not None:
+        stale = stale.limit(limit)
+    return db.session.execute(events.delete().where(events.c.id.in_(stale))).rowcount
+
+
+def publish_pin(pin_guid, topic_ids, event_type, replace=True):
+    """Fan a shared pin event out inline, or queue a FanOutJob for large topics.
+
+    Returns the (user_id, id) of each event written inline.
+    """
+    topic_ids = [topic_id for topic_id in topic_ids if topic_id is not None]
+    db.session.flush()
+    now = datetime.datetime.utcnow()
+    outstanding = FanOutJob.query.filter(FanOutJob.pin_id == pin_guid, FanOutJob.status.in_(FAN_OUT_JOB_OUTSTANDING))
+    if not replace:
+        outstanding = outstanding.filter(FanOutJob.replace_events.is_(False))
+    outstanding.update({'status': 'superseded', 'update_time': now}, synchronize_session=False)
+    if not topic_ids:
+        _prune_pin_events(pin_guid, topic_ids)
+        return []
+
+    inline_max = config['FANOUT_INLINE_MAX']
+    events = UserTimeline.__table__
+    sampled_subscribers = _topic_subscribers(topic_ids).limit(inline_max + 1).alias()
+    sampled_events = select([events.c.id]).where(events.c.pin_id == pin_guid).limit(inline_max + 1).alias()
+    subscriber_count, event_count = db.session.execute(select([
+        select([func.count()]).select_from(sampled_subscribers).as_scalar(),
+        select([func.count()]).select_from(sampled_events).as_scalar(),
+    ])).first()
+    if subscriber_count <= inline_max and event_count <= inline_max:
+        written = fan_out_pin(pin_guid, topic_ids, event_type, replace=replace)
+        FAN_OUT_EVENTS.labels('inline').observe(len(written))
+        _prune_pin_events(pin_guid, topic_ids)
+        return written
+
+    db.session.add(FanOutJob(pin_id=pin_guid, type=event_type, topic_ids=topic_ids, replace_events=replace,
+                             status='pending', events_written=0, create_time=now, update_time=now))
+    return []
+
+
+def _run_fan_out_chunk(job, chunk_size):
+    job.update_time = datetime.datetime.utcnow()
+    if job.status != 'pruning':
+        chunk = _topic_subscribers(job.topic_ids, job.last_user_id) \
+            .order_by(TimelineTopicSubscription.user_id) \
+            .limit(chunk_size) \
+            .alias()
+        up_to_user_id = db.session.execute(select([func.max(chunk.c.user_id)])).scalar()
+        if up_to_user_id is not None:
+            written = fan_out_pin(job.pin_id, job.topic_ids, job.type, job.last_user_id, up_to_user_id, job.replace_events)
+            record_user_changes(timeline_events=written)
+            job.events_written += len(written)
+            job.last_user_id = up_to_user_id
+            job.status = 'running'
+            return True
+        job.status = 'pruning'
+
+    if _prune_pin_events(job.pin_id, job.topic_ids, chunk_size) == chunk_size:
+        return True
+    job.status = 'done'
+    FAN_OUT_EVENTS.labels('queued').observe(job.events_written)
+    return False
+
+
+def process_fan_out_jobs(app, time_budget=None):
+    """Work through queued fan-out jobs until there are none or time runs out."""
+    with app.app_context():
+        chunk_size = config['FANOUT_CHUNK_SIZE']
+        deadline = time.monotonic() + (config['FANOUT_TIME_BUDGET'] if time_budget is None else time_budget)
+        chunks = 0
+        while time.monotonic() < deadline:
+            job = FanOutJob.query.filter(FanOutJob.status.in_(FAN_OUT_JOB_OUTSTANDING)) \
+                .order_by(FanOutJob.id) \
+                .with_for_update(skip_locked=True) \
+                .first()
+            if job is None:
+                break
+            _run_fan_out_chunk(job, chunk_size)
+            db.session.commit()
+            chunks += 1
+        db.session.remove()
+        return chunks
+
+
+def _expire_pins_chunk(cutoff, chunk_size):
+    pins = TimelinePin.__table__
+    expired = select([pins.c.guid]).where(pins.c.time < cutoff).limit(chunk_size).with_for_update(skip_locked=True)
+    return db.session.execute(pins.delete().where(pins.c.guid.in_(expired))).rowcount
+
+
+def _expire_slices_chunk(cutoff, chunk_size):
+    slices = AppGlanceSlice.__table__
+    expired = select([slices.c.id]).where(slices.c.expiration < cutoff).limit(chunk_size).with_for_update(skip_locked=True)
+    glance_ids = [glance_id for glance_id, in
+                  db.session.execute(slices.delete().where(slices.c.id.in_(expired)).returning(slices.c.app_glance_id))]
+
+    # Glances losing slices no longer match their stored payloads, so they
+    # are encoded again.  They are locked first, in id order: of two chunks
+    # expiring slices of the same glance, the one that gets there second
+    # sees what the first deleted, and writes the payload that sticks.
+    stale = sorted({glance_id for glance_id in glance_ids if glance_id is not None})
+    if stale:
+        for glance in AppGlance.query.filter(AppGlance.id.in_(stale)).order_by(AppGlance.id) \
+                .with_for_update().populate_existing().options(selectinload(AppGlance.slices)):
+            glance.payload = json.dumps(glance.to_json()['data'])
+    return len(glance_ids)
+
+
+def _expire_rate_limit_buckets_chunk(cutoff, chunk_size):
+    buckets = RateLimitBucket.__table__
+    expired = select([buckets.c.key]).where(buckets.c.update_time < cutoff).limit(chunk_size).with_for_update(skip_locked=True)
+    return db.session.execute(buckets.delete().where(buckets.c.key.in_(expired))).rowcount
+
+
+# Pins and their events are deliberately not partitioned by time, even though
+# dropping a day's partition is far cheaper than deleting its rows (see
+# benchmarks/partitioning.py).  Postgres wants the partition key in every
+# unique index.  The upserts rely on pins being unique by (app_uuid, user_id,
+# id) and events by (user_id, pin_id) whatever their time, and a pin whose
+# time changes would have to move between partitions.  If chunked deletes stop
+# keeping up, partition user_timeline alone, by a denormalized expiry column.
+def delete_expired_pins(app, time_budget=None):
+    """Delete expired pins, glance slices and full rate limit buckets a chunk at a time, until there are none or time runs out.
+
+    Each chunk is its own short transaction, picked by index and claimed with
+    SKIP LOCKED, so this can run as often as we like, alongside writers and
+    other runs of itself.  Whatever is left over is picked up by the next run.
+    Returns the number of rows deleted, by kind.
+    """
+    with app.app_context():
+        chunk_size = config['EXPIRY_CHUNK_SIZE']
+        deadline = time.monotonic() + (config['EXPIRY_TIME_BUDGET'] if time_budget is None else time_budget)
+        now = datetime.datetime.utcnow()
+        refill_time = datetime.timedelta(seconds=max(config['RATE_LIMIT_APP_BURST'] / config['RATE_LIMIT_APP_RATE'],
+                                                     config['RATE_LIMIT_USER_BURST'] / config['RATE_LIMIT_USER_RATE']))
+        pending = {
+            'pins': lambda: _expire_pins_chunk(now - PIN_RETENTION, chunk_size),
+            'slices': lambda: _expire_slices_chunk(now, chunk_size),
+            'rate_limit_buckets': lambda: _expire_rate_limit_buckets_chunk(now - refill_time, chunk_size),
+        }
+        deleted = dict.fromkeys(pending, 0)
+        while pending and time.monotonic() < deadline:
+            # Take turns, so that a backlog of pins cannot hold up slices.
+            for kind, expire_chunk in list(pending.items()):
+                start = time.monotonic()
+                rows = expire_chunk()
+                db.session.commit()
+                logger.info("Expired %d %s in %.3fs", rows, kind, time.monotonic() - start)
+                EXPIRED_ROWS.labels(kind).inc(rows)
+                deleted[kind] += rows
+                if rows < chunk_size:
+                    del pending[kind]
+        db.session.remove()
+        return deleted
+
+def _compact_tombstones_chunk(cutoff, chunk_size):
+    pins = TimelinePin.__table__
+    events = UserTimeline.__table__
+    guids = [guid for guid, in db.session.execute(select([pins.c.guid])
+                                                  .where(pins.c.deleted_time < cutoff)
+                                                  .limit(chunk_size)
+                                                  .with_for_update(skip_locked=True))]
+    if not guids:
+        return 0
+
+    horizons = db.session.execute(select([events.c.user_id, func.max(events.c.id)])
+                                  .where(and_(events.c.pin_id.in_(guids), events.c.user_id.isnot(None)))
+                                  .group_by(events.c.user_id)).fetchall()
+    if horizons:
+        # In user_id order, like record_user_changes(), so as not to deadlock with it.
+        versions = UserSyncVersion.__table__
+        upsert = insert(versions).values([{'user_id': user_id, 'timeline_id': event_id, 'compacted_id': event_id}
+                                          for user_id, event_id in sorted(horizons)])
+        upsert = upsert.on_conflict_do_update(index_elements=['user_id'],
+                                              set_={'compacted_id': func.greatest(versions.c.compacted_id, upsert.excluded.compacted_id)})
+        db.session.execute(upsert)
+
+    # Their events, topics and fan-out jobs go too, by cascade.
+    db.session.execute(pins.delete().where(pins.c.guid.in_(guids)))
+    return len(guids)
+
+
+def compact_tombstones(app, time_budget=None):
+    """Drop pins deleted more than TOMBSTONE_GRACE_DAYS ago, with their delete events, a chunk at a time.
+
+    Clients that synced during the grace period have seen the deletes
+    already.  Any that haven't can't be caught up any more, so each user's
+    compaction horizon moves up past the events dropped, and syncs from
+    before it are told to start over.  Returns the number of pins dropped.
+    """
+    with app.app_context():
+        chunk_size = config['EXPIRY_CHUNK_SIZE']
+        deadline = time.monotonic() + (config['EXPIRY_TIME_BUDGET'] if time_budget is None else time_budget)
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=config['TOMBSTONE_GRACE_DAYS'])
+        compacted = 0
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            rows = _compact_tombstones_chunk(cutoff, chunk_size)
+            db.session.commit()
+            logger.info("Compacted %d deleted pins in %.3fs", rows, time.monotonic() - start)
+            EXPIRED_ROWS.labels('deleted_pins').inc(rows)
+            compacted += rows
+            if rows < chunk_size:
+                break
+        db.session.remove()
+        return compacted
+
+
+# Meant to be run once in command line, after deploying glance events, to pick
+# up glances written between the migration and the deploy.
+def backfill_glance_events():
+    db.session.execute("""
+        WITH events AS (
+            INSERT INTO user_timeline (user_id, type, glance_id)
+            SELECT user_id, 'appglance.slice.create', id FROM app_glances
+            WHERE user_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM user_timeline WHERE glance_id = app_glances.id)
+            ORDER BY id
+            RETURNING user_id, id
+        )
+        INSERT INTO user_sync_versions (user_id, timeline_id)
+        SELECT user_id, max(id) FROM events GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET timeline_id = GREATEST(user_sync_versions.timeline_id, excluded.timeline_id)
+    """)
+    db.session.commit()
+
+
+# Meant to be run in command line after deploying stored payloads; syncs
+# cope without them, just more slowly.
+def backfill_payloads(chunk_size=1000):
+    while True:
+        pins = TimelinePin.query.filter(TimelinePin.payload.is_(None)).limit(chunk_size).all()
+        glances = AppGlance.query.filter(AppGlance.payload.is_(None)).limit(chunk_size).all()
+        if not pins and not glances:
+            break
+        for pin in pins:
+            pin.payload = json.dumps(pin.to_json())
+        for glance in glances:
+            glance.payload = json.dumps(glance.to_json()['data'])
         db.session.commit()
+        print(f"Stored payloads for {len(pins)} pins and {len(glances)} glances")
 
 # Meant to be run once in command line to clean up after b77d214fe44c5c6a82e25e012bb9c917c2649fea.
 def cleanup_duplicate_usertimeline():
-    all_pins = UserTimeline.query.with_entities(UserTimeline.pin_id, func.count(UserTimeline.pin_id).label('total')).group_by(UserTimeline.pin_id).all()
+    all_pins = UserTimeline.query.with_entities(UserTimeline.pin_id, func.count(UserTimeline.pin_id).label('total')).filter(UserTimeline.pin_id.isnot(None)).group_by(UserTimeline.pin_id).all()
 
     for pin, count in all_pins:
         if count <= 1:
@@ -0,0 +1,112 @@
+from collections import defaultdict
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+from sqlalchemy import text
+
+from .settings import config
+
+logger = logging.getLogger(__name__)
+
+# Writers tell waiting syncs that a user has something new over this channel;
+# the payload is a comma-separated list of user ids.
+CHANNEL = 'timeline_sync'
+MAX_PAYLOAD = 7900  # Postgres refuses payloads of 8000 bytes or more.
+
+
+def notify_users(session, user_ids):
+    """Queue a wake-up for `user_ids`; Postgres delivers it when the transaction commits."""
+    if not config['LONGPOLL_MAX_WAIT']:
+        return  # Nobody will be listening.
+    payload = ''
+    for user_id in sorted(set(user_ids)):
+        user_id = str(user_id)
+        if payload and len(payload) + len(user_id) + 1 > MAX_PAYLOAD:
+            session.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': CHANNEL, 'payload': payload})
+            payload = ''
+        payload = f"{payload},{user_id}" if payload else user_id
+    if payload:
+        session.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': CHANNEL, 'payload': payload})
+
+
+class SyncListener(threading.Thread):
+    """Holds the process's one LISTEN connection and wakes up waiting syncs."""
+
+    def __init__(self, dsn):
+        super().__init__(name='sync-listener', daemon=True)
+        self.dsn = dsn
+        self._waiters = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def register(self, user_id):
+        event = threading.Event()
+        with self._lock:
+            self._waiters[user_id].add(event)
+        return event
+
+    def unregister(self, user_id, event):
+        with self._lock:
+            waiters = self._waiters.get(user_id)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[user_id]
+
+    def _wake(self, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                events = [event for waiters in self._waiters.values() for event in waiters]
+            else:
+                events = [event for user_id in user_ids for event in self._waiters.get(user_id, ())]
+        for event in events:
+            event.set()
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {CHANNEL}')
+        try:
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notification = conn.notifies.pop(0)
+                    user_ids = set()
+                    for user_id in notification.payload.split(','):
+                        try:
+                            user_ids.add(int(user_id))
+                        except ValueError:
+                            pass
+                    self._wake(user_ids)
+        finally:
+            conn.close()
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Sync listener connection failed; reconnecting")
+            # Anything could have happened while we weren't listening, so let
+            # everybody go and look for themselves.
+            self._wake()
+            time.sleep(1)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener():
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = SyncListener(config['SQLALCHEMY_DATABASE_URI'])
+                _listener.start()
+    return _listener
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import math
+import threading
+import time
+
+from flask import request
+
+from .models import lease_rate_limit_tokens
+from .settings import config
+from .utils import _token_key, api_error, batch_items
+
+import beeline
+
+# Batch endpoints cost a token per pin.
+BATCH_ENDPOINTS = {'api.user_pins_batch', 'api.shared_pins_batch'}
+
+
+class TokenBuckets:
+    """Token buckets by key, kept in this process's memory.
+
+    Buckets fill at `rate` tokens a second, up to `burst`.  Keys that have
+    not been seen in a while are forgotten first, which is the same as their
+    bucket filling up.
+    """
+
+    def __init__(self, name, rate, burst, maxsize):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, time)
+        self._lock = threading.Lock()
+
+    def take(self, key, cost=1):
+        """Take `cost` tokens, returning 0 if there were enough, or else the seconds until there will be."""
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            wait = 0 if tokens >= cost else (cost - tokens) / self.rate
+            self._buckets[key] = (tokens - cost if not wait else tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def refund(self, key, cost=1):
+        """Put back tokens taken for a request that was turned away after all."""
+        cost = min(cost, self.burst)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                self._buckets[key] = (min(self.burst, bucket[0] + cost), bucket[1])
+
+
+class SharedTokenBuckets:
+    """Token buckets by key, shared between workers through Postgres.
+
+    Each worker leases tokens a few at a time and hands them out from memory,
+    so that most requests never touch the database.  A worker can sit on up
+    to RATE_LIMIT_LEASE unused tokens per key, which is the price of that.
+    """
+
+    def __init__(self, name, rate, burst, maxsize):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._leases = OrderedDict()  # key -> tokens
+        self._lock = threading.Lock()
+
+    def _add_lease(self, key, tokens):
+        with self._lock:
+            self._leases[key] = self._leases.get(key, 0) + tokens
+            self._leases.move_to_end(key)
+            while len(self._leases) > self.maxsize:
+                self._leases.popitem(last=False)
+
+    def take(self, key, cost=1):
+        cost = min(cost, self.burst)
+        with self._lock:
+            leased = self._leases.pop(key, 0)
+        if leased < cost:
+            granted, available = lease_rate_limit_tokens(f"{self.name}:{key}", max(config['RATE_LIMIT_LEASE'], cost - leased),
+                                                         cost - leased, self.rate, self.burst)
+            if not granted:
+                self._add_lease(key, leased)
+                return (cost - leased - available) / self.rate
+            leased += granted
+        self._add_lease(key, leased - cost)
+        return 0
+
+    def refund(self, key, cost=1):
+        self._add_lease(key, min(cost, self.burst))
+
+
+def _make_buckets(name, rate, burst):
+    buckets = SharedTokenBuckets if config['RATE_LIMIT_BACKEND'] == 'postgres' else TokenBuckets
+    return buckets(name, rate, burst, config['RATE_LIMIT_MAX_KEYS'])
+
+
+app_buckets = _make_buckets('app', config['RATE_LIMIT_APP_RATE'], config['RATE_LIMIT_APP_BURST'])
+user_buckets = _make_buckets('user', config['RATE_LIMIT_USER_RATE'], config['RATE_LIMIT_USER_BURST'])
+
+
+def _user_token():
+    token = request.headers.get('X-User-Token') or request.args.get('access_token')
+    if not token:
+        auth = request.headers.get('Authorization', '').split(' ')
+        if len(auth) == 2 and auth[0] == 'Bearer':
+            token = auth[1]
+    return token
+
+
+def _request_cost():
+    items = batch_items() if request.endpoint in BATCH_ENDPOINTS else None
+    return len(items) if items else 1
+
+
+def _user_token_costs():
+    """What the request costs each user token it carries."""
+    items = batch_items() if request.endpoint == 'api.user_pins_batch' else None
+    if not items:
+        token = _user_token()
+        return {token: _request_cost()} if token else {}
+
+    # Batch items can carry user tokens of their own, each of which is an
+    # appstore lookup; every token pays for the items it is used for.
+    header_token = request.headers.get('X-User-Token')
+    costs = {}
+    for item in items:
+        token = item.get('userToken', header_token) if isinstance(item, dict) else None
+        if isinstance(token, str):
+            costs[token] = costs.get(token, 0) + 1
+    return costs
+
+
+def check_rate_limits():
+    """Turn away a request whose API key or user token has run out of tokens.
+
+    This runs before the tokens are resolved, or anything else touches the
+    database, so a flood costs us as little as possible.
+    """
+    if config['RATE_LIMIT_BACKEND'] == 'off':
+        return None
+    api_key = request.headers.get('X-API-Key')
+    limits = [('app', app_buckets, api_key, _request_cost())] if api_key else []
+    limits += [('user', user_buckets, token, cost) for token, cost in _user_token_costs().items()]
+    taken = []
+    for kind, buckets, token, cost in limits:
+        key = _token_key(token)
+        wait = buckets.take(key, cost)
+        if wait:
+            # A request that is turned away doesn't cost its other tokens anything.
+            for buckets, key, cost in taken:
+                buckets.refund(key, cost)
+            beeline.add_context_field('timeline.rate_limited', kind)
+            response = api_error(429)
+            response.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+            return response
+        taken.append((buckets, key, cost))
+    return None
@@ -9,5 +9,40 @@ config = {
     'REBBLE_AUTH_URL': environ.get('REBBLE_AUTH_URL', f"{http_protocol}://auth.{domain_root}"),
     'APPSTORE_API_URL': environ.get('APPSTORE_API_URL', f"{http_protocol}://appstore-api.{domain_root}"),
     'SECRET_KEY': environ.get('SECRET_KEY'),
+    'WORKER_TOKEN': environ.get('WORKER_TOKEN'),  # Bearer token for /tasks/*; unset turns those routes off.
     'HONEYCOMB_KEY': environ.get('HONEYCOMB_KEY', None),
+    'TOKEN_CACHE_SIZE': int(environ.get('TOKEN_CACHE_SIZE', 10000)),
+    'TOKEN_CACHE_TTL': int(environ.get('TOKEN_CACHE_TTL', 300)),
+    'TOKEN_CACHE_NEGATIVE_TTL': int(environ.get('TOKEN_CACHE_NEGATIVE_TTL', 60)),
+    'UID_CACHE_SIZE': int(environ.get('UID_CACHE_SIZE', 10000)),
+    'UID_CACHE_TTL': int(environ.get('UID_CACHE_TTL', 30)),  # Seconds a revoked access token can still sync for.
+    'TOPIC_CACHE_SIZE': int(environ.get('TOPIC_CACHE_SIZE', 10000)),
+    'TOPIC_CACHE_TTL': int(environ.get('TOPIC_CACHE_TTL', 3600)),
+    'SYNC_PAGE_LIMIT': int(environ.get('SYNC_PAGE_LIMIT', 500)),
+    'SYNC_STREAM_BATCH': int(environ.get('SYNC_STREAM_BATCH', 100)),
+    'LONGPOLL_MAX_WAIT': int(environ.get('LONGPOLL_MAX_WAIT', 0)),  # Seconds; 0 turns long-polling off.
+    'GZIP_LEVEL': int(environ.get('GZIP_LEVEL', 6)),  # 0 turns compression off.
+    'GZIP_MIN_SIZE': int(environ.get('GZIP_MIN_SIZE', 1024)),
+    'PIN_MAX_BYTES': int(environ.get('PIN_MAX_BYTES', 32768)),
+    'GLANCE_MAX_BYTES': int(environ.get('GLANCE_MAX_BYTES', 32768)),
+    'BATCH_MAX_PINS': int(environ.get('BATCH_MAX_PINS', 1000)),
+    'FANOUT_INLINE_MAX': int(environ.get('FANOUT_INLINE_MAX', 2000)),
+    'FANOUT_CHUNK_SIZE': int(environ.get('FANOUT_CHUNK_SIZE', 5000)),
+    'FANOUT_TIME_BUDGET': float(environ.get('FANOUT_TIME_BUDGET', 20)),
+    'RATE_LIMIT_BACKEND': environ.get('RATE_LIMIT_BACKEND', 'memory'),  # 'memory', 'postgres', or 'off'.
+    'RATE_LIMIT_APP_RATE': float(environ.get('RATE_LIMIT_APP_RATE', 100)),  # Tokens a second, per API key.
+    'RATE_LIMIT_APP_BURST': float(environ.get('RATE_LIMIT_APP_BURST', 1000)),
+    'RATE_LIMIT_USER_RATE': float(environ.get('RATE_LIMIT_USER_RATE', 10)),  # Tokens a second, per user token.
+    'RATE_LIMIT_USER_BURST': float(environ.get('RATE_LIMIT_USER_BURST', 100)),
+    'RATE_LIMIT_LEASE': int(environ.get('RATE_LIMIT_LEASE', 10)),
+    'RATE_LIMIT_MAX_KEYS': int(environ.get('RATE_LIMIT_MAX_KEYS', 100000)),
+    'EXPIRY_CHUNK_SIZE': int(environ.get('EXPIRY_CHUNK_SIZE', 1000)),
+    'EXPIRY_TIME_BUDGET': float(environ.get('EXPIRY_TIME_BUDGET', 20)),
+    'TOMBSTONE_GRACE_DAYS': int(environ.get('TOMBSTONE_GRACE_DAYS', 30)),
+    'SLOW_QUERY_MS': float(environ.get('SLOW_QUERY_MS', 500)),  # 0 turns the slow query log off.
+    'UPSTREAM_CONNECT_TIMEOUT': float(environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05)),
+    'UPSTREAM_READ_TIMEOUT': float(environ.get('UPSTREAM_READ_TIMEOUT', 10)),
+    'UPSTREAM_RETRIES': int(environ.get('UPSTREAM_RETRIES', 2)),
+    'UPSTREAM_RETRY_BACKOFF': float(environ.get('UPSTREAM_RETRY_BACKOFF', 0.1)),
+    'UPSTREAM_POOL_SIZE': int(environ.get('UPSTREAM_POOL_SIZE', 10)),
 }
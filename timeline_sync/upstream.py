@@ -0,0 +1,72 @@
+from urllib.parse import urlsplit
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .instrumentation import record_upstream
+from .settings import config
+
+import beeline
+
+# One requests.Session per upstream host, so that calls to the auth service and
+# the appstore reuse keep-alive connections rather than doing a TCP and TLS
+# handshake every time.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _make_session():
+    # Read timeouts are not retried: a hung upstream would otherwise hold the
+    # thread for several UPSTREAM_READ_TIMEOUTs, past the Lambda timeout.
+    retries = Retry(total=config['UPSTREAM_RETRIES'],
+                    connect=config['UPSTREAM_RETRIES'],
+                    read=0,
+                    status=config['UPSTREAM_RETRIES'],
+                    backoff_factor=config['UPSTREAM_RETRY_BACKOFF'],
+                    status_forcelist=(502, 503, 504),
+                    method_whitelist=frozenset(['GET']),
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=config['UPSTREAM_POOL_SIZE'],
+                          max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _session_for(host):
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = _sessions[host] = _make_session()
+    return session
+
+
+def request(method, url, **kwargs):
+    host = urlsplit(url).netloc
+    kwargs.setdefault('timeout', (config['UPSTREAM_CONNECT_TIMEOUT'], config['UPSTREAM_READ_TIMEOUT']))
+    with beeline.tracer(name='upstream'):
+        beeline.add_context_field('upstream.host', host)
+        beeline.add_context_field('upstream.method', method)
+        start = time.monotonic()
+        try:
+            result = _session_for(host).request(method, url, **kwargs)
+        except requests.RequestException as e:
+            beeline.add_context_field('upstream.error', type(e).__name__)
+            raise
+        finally:
+            duration_ms = (time.monotonic() - start) * 1000
+            beeline.add_context_field('upstream.duration_ms', duration_ms)
+            record_upstream(duration_ms)
+        beeline.add_context_field('upstream.status_code', result.status_code)
+        return result
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
@@ -1,7 +1,11 @@
-import requests
 from flask import request, abort, jsonify
+from .cache import TTLCache
+from . import upstream
 from .settings import config
 import datetime
+import hashlib
+import json
+import re
 
 import beeline
 
@@ -16,6 +20,13 @@ ERROR_CODES = {
 
 ISO_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 ISO_FORMAT_MSEC = '%Y-%m-%dT%H:%M:%S.%fZ'
+# What clients send nearly all the time; it matches both of the above.
+ISO_TIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?Z')
+
+# Access token -> uid.  Keys are hashed so that we never hold on to raw tokens.
+# Only a miss asks the auth service, so a revoked token keeps working for up to
+# UID_CACHE_TTL; keep that short.
+uid_cache = TTLCache('uid', config['UID_CACHE_SIZE'], config['UID_CACHE_TTL'])
 
 # Copied from https://github.com/pebble-dev/rebble-appstore-api/blob/master/appstore/utils.py
 # Really should be in common library
@@ -35,18 +46,36 @@ def get_access_token():
     return access_token
 
 
+def _token_key(access_token):
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
 def authed_request(method, url, **kwargs):
     headers = kwargs.setdefault('headers', {})
     headers['Authorization'] = f'Bearer {get_access_token()}'
-    return requests.request(method, url, **kwargs)
+    return upstream.request(method, url, **kwargs)
 
 
 def get_uid():
-    result = authed_request('GET', f"{config['REBBLE_AUTH_URL']}/api/v1/me")
-    if result.status_code != 200:
-        abort(401)
-    beeline.add_context_field("user", result.json()['uid'])
-    return result.json()['uid']
+    key = _token_key(get_access_token())
+    uid = uid_cache.get(key)
+    if uid is None:
+        result = authed_request('GET', f"{config['REBBLE_AUTH_URL']}/api/v1/me")
+        if result.status_code != 200:
+            abort(401)
+        uid = result.json()['uid']
+        uid_cache.set(key, uid)
+    beeline.add_context_field("user", uid)
+    return uid
+
+
+def batch_items():
+    """The items of a batch request, or None if it is not a well-formed batch of at most BATCH_MAX_PINS."""
+    body = request.get_json(silent=True)
+    items = body.get('pins') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items or len(items) > config['BATCH_MAX_PINS']:
+        return None
+    return items
 
 
 def api_error(code):
@@ -57,11 +86,18 @@ def api_error(code):
 
 
 def parse_time(time_str):
+    match = ISO_TIME.fullmatch(time_str)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                 int(fraction.ljust(6, '0')) if fraction else 0)
+
+    # Anything else strptime() would still have, such as unpadded fields.
     try:
         return datetime.datetime.strptime(time_str, ISO_FORMAT)
     except ValueError:
         pass
-    
+
     return datetime.datetime.strptime(time_str, ISO_FORMAT_MSEC)
 
 
@@ -69,6 +105,12 @@ def time_to_str(time):
     return time.strftime(ISO_FORMAT)
 
 
+def content_hash(content):
+    """A stable hash of a JSON-able value, to tell whether a client resent the same thing."""
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
 def time_valid(time):
     now = datetime.datetime.utcnow()
     if (time < now and (now - time).days > 2) or (time > now and (time - now).days > 366):
@@ -76,49 +118,104 @@ def time_valid(time):
     return True
 
 
-def pin_valid(pin_id, pin_json):
+def _encoded_size(value):
+    return len(json.dumps(value, separators=(',', ':')))
+
+
+def pin_content(pin_json):
+    """A pin's JSON mapped onto TimelinePin's content columns, its time parsed."""
+    return {
+        'time': parse_time(pin_json['time']),
+        'duration': pin_json.get('duration'),
+        'create_notification': pin_json.get('createNotification'),
+        'update_notification': pin_json.get('updateNotification'),
+        'layout': pin_json['layout'],
+        'reminders': pin_json.get('reminders'),
+        'actions': pin_json.get('actions'),
+    }
+
+
+def validate_pin(pin_id, pin_json):
+    """Check a pin in one pass, returning its pin_content(), or None.
+
+    That is what TimelinePin.content_from_json() starts from, so the pin
+    needn't be parsed again.
+    """
     try:
-        if pin_json is None or pin_json.get('id') != pin_id:
+        if not isinstance(pin_json, dict) or pin_json.get('id') != pin_id:
             beeline.add_context_field('timeline.failure.details', 'parse_failure_or_id_mismatch')
-            return False
-        if not time_valid(parse_time(pin_json['time'])):
+            return None
+        if _encoded_size(pin_json) > config['PIN_MAX_BYTES']:
+            beeline.add_context_field('timeline.failure.details', 'too_large')
+            return None
+        content = pin_content(pin_json)
+        if not isinstance(content['layout'], dict) or \
+                not isinstance(content['duration'], (int, type(None))) or \
+                not isinstance(content['create_notification'], (dict, type(None))) or \
+                not isinstance(content['update_notification'], (dict, type(None))) or \
+                not isinstance(content['reminders'], (list, type(None))) or \
+                not isinstance(content['actions'], (list, type(None))):
+            beeline.add_context_field('timeline.failure.details', 'invalid_structure')
+            return None
+        if not time_valid(content['time']):
             beeline.add_context_field('timeline.failure.details', 'invalid_time')
-            return False
-        if 'createNotification' in pin_json and 'time' in pin_json['createNotification']:
+            return None
+        if content['create_notification'] is not None and 'time' in content['create_notification']:
             beeline.add_context_field('timeline.failure.details', 'invalid_time_attribute')
-            return False  # The createNotification type does not require a time attribute.
-        if 'updateNotification' in pin_json and not time_valid(parse_time(pin_json['updateNotification']['time'])):
+            return None  # The createNotification type does not require a time attribute.
+        if content['update_notification'] is not None and not time_valid(parse_time(content['update_notification']['time'])):
             beeline.add_context_field('timeline.failure.details', 'invalid_time_for_update')
-            return False
-        if 'reminders' in pin_json:
-            if len(pin_json['reminders']) > 3:
+            return None
+        if content['reminders'] is not None:
+            if len(content['reminders']) > 3:
                 beeline.add_context_field('timeline.failure.details', 'too_many_reminders')
-                return False  # Max 3 reminders
-            for reminder in pin_json['reminders']:
+                return None  # Max 3 reminders
+            for reminder in content['reminders']:
                 if not time_valid(parse_time(reminder['time'])):
                     beeline.add_context_field('timeline.failure.details', 'invalid_reminder_time')
-                    return False
+                    return None
     except (KeyError, ValueError, TypeError):
         beeline.add_context_field('timeline.failure.details', 'miscellaneous_failure')
-        return False
-    return True
+        return None
+    return content
 
 
-def glance_valid(glance_json):
+def pin_valid(pin_id, pin_json):
+    return validate_pin(pin_id, pin_json) is not None
+
+
+def validate_glance(glance_json):
+    """Check a glance in one pass, returning its slices' column values, or None."""
     try:
-        if glance_json is None:
+        if not isinstance(glance_json, dict):
             beeline.add_context_field('glance.failure.details', 'parse_failure')
-            return False
-        if 'slices' in glance_json:
-            for glance_slice in glance_json['slices']:
-                if 'expirationTime' in glance_slice and not parse_time(glance_slice['expirationTime']):
-                    beeline.add_context_field('glance.failure.details', 'invalid_expiration_time')
-                    return False
-        else:
+            return None
+        if 'slices' not in glance_json:
             beeline.add_context_field('glance.failure.details', 'no_slices')
-            return False
+            return None
+        if not isinstance(glance_json['slices'], list) or \
+                not all(isinstance(glance_slice, dict) and isinstance(glance_slice.get('layout'), dict)
+                        for glance_slice in glance_json['slices']):
+            beeline.add_context_field('glance.failure.details', 'invalid_structure')
+            return None
+        if _encoded_size(glance_json) > config['GLANCE_MAX_BYTES']:
+            beeline.add_context_field('glance.failure.details', 'too_large')
+            return None
+        slices = []
+        for glance_slice in glance_json['slices']:
+            expiration = None
+            if 'expirationTime' in glance_slice:
+                try:
+                    expiration = parse_time(glance_slice['expirationTime'])
+                except (ValueError, TypeError):
+                    beeline.add_context_field('glance.failure.details', 'invalid_expiration_time')
+                    return None
+            slices.append({'layout': glance_slice['layout'], 'expiration': expiration})
     except (KeyError, ValueError, TypeError):
         beeline.add_context_field('glance.failure.details', 'miscellaneous_failure')
-        return False
-    return True
+        return None
+    return slices
+
 
+def glance_valid(glance_json):
+    return validate_glance(glance_json) is not None